@@ -4,8 +4,9 @@ import numpy as np
 
 
 class agent:
-    def __init__(self, n_features, n_actions):
+    def __init__(self, n_features, n_actions, seed=None):
         self.n_features = n_features
+        self.rng = np.random.default_rng(seed)
         # self.action_space = list(range(n_actions))
         self.action_space = [8]
 
@@ -15,8 +16,50 @@ class agent:
 
 
 class RandomAgent(agent):
-    def __init__(self, n_features, n_actions):
-        super(RandomAgent, self).__init__(n_features, n_actions)
+    def __init__(self, n_features, n_actions, seed=None, block_size=4096):
+        super(RandomAgent, self).__init__(n_features, n_actions, seed)
+        self.block_size = block_size
+        self.actions = []
+        self.idx = 0
 
     def act(self, states):
-        return np.random.choice(self.action_space)
+        # actions are drawn in blocks, a scalar rng call per step is slow
+        if self.idx >= len(self.actions):
+            self.actions = self.rng.choice(self.action_space, self.block_size).tolist()
+            self.idx = 0
+        self.idx += 1
+        return self.actions[self.idx - 1]
+
+
+class GreedyAgent(agent):
+    """
+    epsilon-greedy on an ActionValueFunction over all actions
+    """
+    def __init__(self, n_features, n_actions, q_function, epsilon=0., seed=None, block_size=4096):
+        super(GreedyAgent, self).__init__(n_features, n_actions, seed)
+        self.action_space = list(range(n_actions))
+        self.q_function = q_function
+        self.epsilon = epsilon
+        self.block_size = block_size
+        self.explore = []
+        self.idx = 0
+
+    def act(self, states):
+        if self.epsilon > 0:
+            if self.idx >= len(self.explore):
+                self.explore = (self.rng.random(self.block_size) < self.epsilon).tolist()
+                self.idx = 0
+            self.idx += 1
+            if self.explore[self.idx - 1]:
+                return int(self.rng.integers(len(self.action_space)))
+        return int(np.argmax(self.q_function.get_value(states)))
+
+    def act_batch(self, states):
+        """
+        one action per row of a (N, k) state array, e.g. as the policy of a VectorSimulator
+        """
+        actions = np.argmax(self.q_function.get_values(states), axis=1)
+        if self.epsilon > 0:
+            explore = self.rng.random(len(actions)) < self.epsilon
+            actions[explore] = self.rng.integers(len(self.action_space), size=np.count_nonzero(explore))
+        return actions
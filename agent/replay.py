@@ -0,0 +1,100 @@
+"""
+Experience replay on preallocated numpy ring buffers. With a path, the buffers are memory-mapped .npy files, so trainer
+processes can open the same buffer and sample from it while a simulation is still writing. There is no lock: until
+the ring is full a reader only sees rows that are completely written, after that a sample can hit the oldest row while
+it is being overwritten and get a mix of the old and the new transition, which replay tolerates like Hogwild updates
+"""
+import os
+import numpy as np
+
+# capacity, state_dim, size, pointer
+_CAPACITY, _STATE_DIM, _SIZE, _POINTER = range(4)
+
+
+class ReplayBuffer:
+    def __init__(self, capacity, state_dim, path=None, alpha=0.6, seed=None, _mode=None):
+        self.path = path
+        self.alpha = alpha  # how much prioritization is used, 0 is uniform
+        self.rng = np.random.default_rng(seed)
+        shapes = {"states": ((capacity, state_dim), np.float64), "actions": ((capacity,), np.int64),
+                  "rewards": ((capacity,), np.float64), "next_states": ((capacity, state_dim), np.float64),
+                  "dones": ((capacity,), np.bool_), "priorities": ((capacity,), np.float64),
+                  "meta": ((4,), np.int64)}
+        if path is None:
+            for name, (shape, dtype) in shapes.items():
+                setattr(self, name, np.zeros(shape, dtype=dtype))
+        else:
+            os.makedirs(path, exist_ok=True)
+            mode = "w+" if _mode is None else _mode
+            for name, (shape, dtype) in shapes.items():
+                filename = os.path.join(path, name + ".npy")
+                if mode == "w+":
+                    setattr(self, name, np.lib.format.open_memmap(filename, mode=mode, dtype=dtype, shape=shape))
+                else:
+                    setattr(self, name, np.load(filename, mmap_mode=mode))
+        if _mode is None:
+            self.meta[:] = [capacity, state_dim, 0, 0]
+        self.capacity = int(self.meta[_CAPACITY])
+        self.max_priority = 1.
+
+    @classmethod
+    def open(cls, path, readonly=True, alpha=0.6, seed=None):
+        """
+        attach to a buffer written by another process
+        """
+        meta = np.load(os.path.join(path, "meta.npy"))
+        return cls(int(meta[_CAPACITY]), int(meta[_STATE_DIM]), path, alpha, seed, _mode="r" if readonly else "r+")
+
+    def __len__(self):
+        return int(self.meta[_SIZE])
+
+    def append(self, state, action, reward, next_state, done):
+        idx = int(self.meta[_POINTER])
+        self.states[idx] = state
+        self.actions[idx] = action
+        self.rewards[idx] = reward
+        self.next_states[idx] = next_state
+        self.dones[idx] = done
+        self.priorities[idx] = self.max_priority  # new transitions are sampled at least once with high probability
+        # grow the readable range only after the row is written, a full ring overwrites rows readers can see
+        self.meta[_SIZE] = min(self.meta[_SIZE] + 1, self.capacity)
+        self.meta[_POINTER] = (idx + 1) % self.capacity
+
+    def get(self, indices):
+        return (self.states[indices], self.actions[indices], self.rewards[indices], self.next_states[indices],
+                self.dones[indices])
+
+    def _check_size(self):
+        if len(self) == 0:
+            raise ValueError("Cannot sample from an empty replay buffer")
+
+    def sample(self, n):
+        """
+        uniform sample, returns (indices, (states, actions, rewards, next_states, dones))
+        """
+        self._check_size()
+        indices = self.rng.integers(len(self), size=n)
+        return indices, self.get(indices)
+
+    def sample_prioritized(self, n, beta=0.4):
+        """
+        sample with probability proportional to priority ** alpha, returns (indices, transitions, weights) where the
+        importance sampling weights are normalized by their maximum
+        """
+        self._check_size()
+        size = len(self)
+        probs = np.power(self.priorities[:size], self.alpha)
+        cdf = np.cumsum(probs)
+        indices = np.minimum(np.searchsorted(cdf, self.rng.random(n) * cdf[-1], side="right"), size - 1)
+        weights = np.power(size * probs[indices] / cdf[-1], -beta)
+        return indices, self.get(indices), weights / weights.max()
+
+    def update_priorities(self, indices, priorities):
+        priorities = np.abs(priorities) + 1e-6
+        self.priorities[indices] = priorities
+        self.max_priority = max(self.max_priority, priorities.max())
+
+    def flush(self):
+        if self.path is not None:
+            for name in ["states", "actions", "rewards", "next_states", "dones", "priorities", "meta"]:
+                getattr(self, name).flush()
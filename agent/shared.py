@@ -0,0 +1,95 @@
+"""
+Value function weights in shared memory, for Hogwild-style training where many worker processes update the same
+weights without locks, plus checkpointing for inference-only agents
+"""
+import os
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+import numpy as np
+
+
+class SharedWeights:
+    def __init__(self, shape, name=None):
+        """
+        create a new block if name is None, otherwise attach to an existing one
+        """
+        self.shape = tuple(shape)
+        size = int(np.prod(self.shape)) * np.dtype(np.float64).itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = np.ndarray(self.shape, dtype=np.float64, buffer=self.shm.buf)
+        self.owner = name is None
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def save_checkpoint(values, filename):
+    # write then rename, a reader never sees a half written checkpoint
+    tmp = filename + ".tmp.npy"
+    np.save(tmp, values)
+    os.replace(tmp, filename)
+
+
+def load_checkpoint(func, filename, mmap=True):
+    """
+    load weights into a value function, memory-mapped read-only by default for inference-only agents
+    """
+    func.attach_values(np.load(filename, mmap_mode="r" if mmap else None))
+    return func
+
+
+def _hogwild_worker(make_function, worker, shm_name, shape, seed):
+    shared = SharedWeights(shape, shm_name)
+    func = make_function()
+    func.attach_values(shared.array)
+    worker(func, seed)
+    del func
+    shared.close()
+
+
+def train_hogwild(make_function, worker, num_workers=None, filename=None, checkpoint_every=60, seed=0):
+    """
+    make_function() builds a value function and worker(func, seed) trains it, both must be picklable (module level).
+    Every worker updates the same shared weights without locks. The weights are checkpointed to filename every
+    checkpoint_every seconds and when all workers finish. Returns the trained value function
+    """
+    num_workers = num_workers or os.cpu_count()
+    func = make_function()
+    func.attach_values(func.values)  # fails here for value functions that cannot share weights
+    shared = SharedWeights(func.values.shape)
+    shared.array[:] = func.values
+    seeds = np.random.SeedSequence(seed).generate_state(num_workers)
+    processes = [mp.Process(target=_hogwild_worker, args=(make_function, worker, shared.name, shared.shape,
+                                                          int(worker_seed)), daemon=True) for worker_seed in seeds]
+    for process in processes:
+        process.start()
+    try:
+        sentinels = [process.sentinel for process in processes]
+        last_checkpoint = time.monotonic()
+        while len(sentinels) > 0:
+            # checkpoints follow the wall clock, however often workers finish
+            timeout = None if filename is None else max(0., last_checkpoint + checkpoint_every - time.monotonic())
+            finished = wait(sentinels, timeout=timeout)
+            sentinels = [sentinel for sentinel in sentinels if sentinel not in finished]
+            if filename is not None and time.monotonic() - last_checkpoint >= checkpoint_every:
+                save_checkpoint(shared.array, filename)
+                last_checkpoint = time.monotonic()
+        for process in processes:
+            process.join()
+        func.values = shared.array.copy()
+    finally:
+        shared.close()
+    if any(process.exitcode != 0 for process in processes):
+        raise RuntimeError("Hogwild worker failed")
+    if filename is not None:
+        save_checkpoint(func.values, filename)
+    return func
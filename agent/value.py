@@ -22,37 +22,18 @@ class ValueFunction:
     def update_value(self, state: Iterable, value):
         pass
 
+    def get_values(self, states: np.ndarray):
+        """
+        values of a (N, k) array of states
+        """
+        return np.array([self.get_value(state) for state in states])
 
-class Tiling(ValueFunction):
-    def __init__(self, state_specs: List[StateSpec], offsets, num_tilings):
-        super(Tiling, self).__init__(state_specs)
-        self.values = np.zeros([spec.num_of_tiles + 1 for spec in state_specs])  # for tiling with offset, we need n + 1 tiles
-        self.num_states = len(state_specs)
-        self.starts = [0] * self.num_states
-        self.tile_widths = [0] * self.num_states
-        self.lbs = np.zeros(self.num_states)
-        self.ubs = np.zeros(self.num_states)
-        for i in range(self.num_states):
-            spec = state_specs[i]
-            self.tile_widths[i] = (spec.ub - spec.lb) / spec.num_of_tiles
-            self.starts[i] = spec.lb - self.tile_widths[i] * ((num_tilings - offsets[i]) % num_tilings) / num_tilings
-            self.lbs[i] = spec.lb
-            self.ubs[i] = spec.ub
-
-    def get_value(self, state: Iterable):
-        return self.values[self.get_indices(state)]
-
-    def update_value(self, state: Iterable, value):
-        self.values[self.get_indices(state)] += value
-
-    def get_indices(self, state: Iterable):
-        # return tuple(((np.maximum(np.minimum(state, self.ubs), self.lbs) - self.starts) / self.tile_widths).astype(int))
-        # return tuple(((state - self.starts) / self.tile_widths).astype(int))
-        # return int((state[0] - self.starts[0]) / self.tile_widths[0])
-        indices = []
-        for val, start, width in zip(state, self.starts, self.tile_widths):
-            indices.append(int((val - start) / width))
-        return tuple(indices)
+    def update_values(self, states: np.ndarray, values):
+        """
+        add values[i] to states[i], repeated states receive every update
+        """
+        for state, value in zip(states, values):
+            self.update_value(state, value)
 
 
 class TileCodingValueFunction(ValueFunction):
@@ -64,18 +45,198 @@ class TileCodingValueFunction(ValueFunction):
         else:
             self.num_tilings = num_tilings
         self.num_tiles = [spec.num_of_tiles for spec in state_specs]
-        self.tilings = []
+
+        self.values = self.init_values()
+        self.tile_widths = np.array([(spec.ub - spec.lb) / spec.num_of_tiles for spec in state_specs])
         offsets = np.array(range(1, 2 * self.num_states + 1, 2), dtype=int)
-        for i in range(self.num_tilings):
-            self.tilings.append(Tiling(state_specs, offsets * i, self.num_tilings))
+        shifts = (self.num_tilings - np.outer(np.arange(self.num_tilings), offsets)) % self.num_tilings
+        lbs = np.array([spec.lb for spec in state_specs])
+        self.starts = lbs - self.tile_widths * shifts / self.num_tilings  # (num_tilings, num_states)
+        self.tiling_ids = np.arange(self.num_tilings)
+
+    def init_values(self):
+        # all tilings live in one array, for tiling with offset, we need n + 1 tiles
+        return np.zeros([self.num_tilings] + [n + 1 for n in self.num_tiles])
+
+    def attach_values(self, values: np.ndarray):
+        """
+        use an external weight array, e.g. in shared memory or memory-mapped from a checkpoint
+        """
+        if values.shape != self.values.shape:
+            raise ValueError("Weight shape mismatch: %s / %s" % (values.shape, self.values.shape))
+        self.values = values
+
+    def get_indices(self, state: Iterable):
+        idx = ((np.asarray(state) - self.starts) / self.tile_widths).astype(int)
+        return (self.tiling_ids,) + tuple(idx.T)
+
+    def get_batch_indices(self, states: np.ndarray):
+        idx = ((np.asarray(states)[:, None, :] - self.starts) / self.tile_widths).astype(int)  # (N, num_tilings, k)
+        return (self.tiling_ids[None, :],) + tuple(np.moveaxis(idx, 2, 0))
 
     def get_value(self, state):
-        value = 0
-        for tiling in self.tilings:
-            value += tiling.get_value(state)
-        return value
+        # cumsum adds up the tilings in order, so the result is the same as looping over them
+        return np.cumsum(self.values[self.get_indices(state)])[-1]
 
     def update_value(self, state, value):
-        delta = value / self.num_tilings
-        for tiling in self.tilings:
-            tiling.update_value(state, delta)
+        self.values[self.get_indices(state)] += value / self.num_tilings
+
+    def get_values(self, states: np.ndarray):
+        return np.cumsum(self.values[self.get_batch_indices(states)], axis=1)[:, -1]
+
+    def update_values(self, states: np.ndarray, values):
+        indices = self.get_batch_indices(states)
+        deltas = np.asarray(values, dtype=float)[:, None] / self.num_tilings
+        np.add.at(self.values, indices, np.broadcast_to(deltas, (len(deltas), self.num_tilings)))
+
+
+class IndexHashTable:
+    """
+    Sutton's IHT: tiles get consecutive indices until the table is full, after which new tiles are hashed into it
+    """
+    def __init__(self, size):
+        self.size = size
+        self.dictionary = {}
+        self.overflows = 0
+
+    def count(self):
+        return len(self.dictionary)
+
+    def full(self):
+        return len(self.dictionary) >= self.size
+
+    def get_index(self, coordinates: tuple):
+        if coordinates in self.dictionary:
+            return self.dictionary[coordinates]
+        if self.full():
+            self.overflows += 1
+            return hash(coordinates) % self.size
+        self.dictionary[coordinates] = len(self.dictionary)
+        return self.dictionary[coordinates]
+
+
+def _mix(keys: np.ndarray):
+    # splitmix64 finalizer, keys are uint64 and overflow wraps around
+    keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return keys ^ (keys >> np.uint64(31))
+
+
+class HashedTileCodingValueFunction(TileCodingValueFunction):
+    """
+    Tile coding into a fixed memory budget. Tiles are not bounded by the state specs and are hashed into memory_size
+    weights, either with an IndexHashTable ("iht") or with vectorized modular hashing ("modular"). Memory does not
+    grow with the number of state dimensions
+    """
+    def __init__(self, state_specs: List[StateSpec], num_tilings=None, memory_size=4096, hashing="modular"):
+        if hashing not in ["modular", "iht"]:
+            raise ValueError("Unknown hashing: %s" % hashing)
+        self.memory_size = memory_size
+        self.hashing = hashing
+        self.iht = IndexHashTable(memory_size)
+        self.owners = np.zeros(memory_size, dtype=np.uint64)  # fingerprint of the tile that first wrote a weight
+        self.collisions = 0
+        super(HashedTileCodingValueFunction, self).__init__(state_specs, num_tilings)
+
+    def init_values(self):
+        return np.zeros(self.memory_size)
+
+    def attach_values(self, values: np.ndarray):
+        # the IHT hands out indices in the order this process meets the tiles, so the same weight would be another
+        # tile in every process and in a checkpoint. Modular hashing is a pure function of the tile
+        if self.hashing == "iht":
+            raise ValueError("Weights of iht hashing cannot be shared, use hashing=\"modular\"")
+        super(HashedTileCodingValueFunction, self).attach_values(values)
+
+    def get_coordinates(self, states: np.ndarray):
+        return np.floor((np.asarray(states)[..., None, :] - self.starts) / self.tile_widths).astype(np.int64)
+
+    def get_keys(self, coordinates: np.ndarray):
+        keys = np.broadcast_to(self.tiling_ids.astype(np.uint64), coordinates.shape[:-1])
+        for i in range(coordinates.shape[-1]):
+            keys = _mix(keys * np.uint64(0x9E3779B97F4A7C15) + coordinates[..., i].astype(np.uint64))
+        return keys
+
+    def hash(self, coordinates: np.ndarray, record=False):
+        if self.hashing == "iht":
+            flat = coordinates.reshape(-1, coordinates.shape[-1]).tolist()
+            tiling_ids = np.broadcast_to(self.tiling_ids, coordinates.shape[:-1]).ravel().tolist()
+            indices = [self.iht.get_index((tiling,) + tuple(coords)) for tiling, coords in zip(tiling_ids, flat)]
+            return np.array(indices).reshape(coordinates.shape[:-1])
+        keys = self.get_keys(coordinates)
+        indices = (keys % np.uint64(self.memory_size)).astype(np.int64)
+        if record:
+            fingerprints = _mix(keys) | np.uint64(1)  # never 0, which marks an unused weight
+            empty = self.owners[indices] == 0
+            self.owners[indices[empty]] = fingerprints[empty]
+            self.collisions += int(np.count_nonzero(self.owners[indices] != fingerprints))
+        return indices
+
+    def get_indices(self, state: Iterable, record=False):
+        return self.hash(self.get_coordinates(state), record)
+
+    def get_batch_indices(self, states: np.ndarray, record=False):
+        return self.hash(self.get_coordinates(states), record)
+
+    def update_value(self, state, value):
+        # different tilings can hash to the same weight, every one of them has to be added
+        np.add.at(self.values, self.get_indices(state, record=True), value / self.num_tilings)
+
+    def update_values(self, states: np.ndarray, values):
+        indices = self.get_batch_indices(states, record=True)
+        deltas = np.asarray(values, dtype=float)[:, None] / self.num_tilings
+        np.add.at(self.values, indices, np.broadcast_to(deltas, indices.shape))
+
+    def get_stats(self):
+        """
+        memory budget and number of weights in use, plus what sharing weights means for the hashing:
+        "overflows" (iht) counts lookups of new tiles once the table was full, which were hashed onto any weight,
+        "collisions" (modular) counts tile writes that landed on a weight first written by another tile
+        """
+        if self.hashing == "iht":
+            return {"memory": self.memory_size, "used": self.iht.count(), "overflows": self.iht.overflows}
+        return {"memory": self.memory_size, "used": int(np.count_nonzero(self.owners)), "collisions": self.collisions}
+
+
+class ActionValueFunction(TileCodingValueFunction):
+    """
+    Tile coded Q-function. The tile indices of a state are shared by all actions, so get_value returns the values of
+    every action with one gather
+    """
+    def __init__(self, state_specs: List[StateSpec], num_actions, num_tilings=None):
+        self.num_actions = num_actions
+        super(ActionValueFunction, self).__init__(state_specs, num_tilings)
+
+    def init_values(self):
+        return np.zeros([self.num_tilings] + [n + 1 for n in self.num_tiles] + [self.num_actions])
+
+    def get_value(self, state):
+        """
+        values of all actions, (num_actions,)
+        """
+        return np.cumsum(self.values[self.get_indices(state)], axis=0)[-1]
+
+    def get_values(self, states: np.ndarray):
+        """
+        values of all actions for a (N, k) array of states, (N, num_actions)
+        """
+        return np.cumsum(self.values[self.get_batch_indices(states)], axis=1)[:, -1]
+
+    def update_value(self, state, action, value):
+        self.values[self.get_indices(state) + (action,)] += value / self.num_tilings
+
+    def update_values(self, states: np.ndarray, actions, values):
+        indices = self.get_batch_indices(states)
+        actions = np.asarray(actions)[:, None]
+        deltas = np.asarray(values, dtype=float)[:, None] / self.num_tilings
+        np.add.at(self.values, indices + (actions,), np.broadcast_to(deltas, (len(deltas), self.num_tilings)))
+
+    def td_update(self, states, actions, rewards, next_states, dones, alpha, gamma=1.):
+        """
+        batched Q-learning update, returns the TD errors
+        """
+        states = np.asarray(states)
+        next_values = self.get_values(next_states).max(axis=1) * (1 - np.asarray(dones, dtype=float))
+        errors = np.asarray(rewards) + gamma * next_values - self.get_values(states)[np.arange(len(states)), actions]
+        self.update_values(states, actions, alpha * errors)
+        return errors
@@ -0,0 +1,249 @@
+"""
+Replay benchmarks on synthetic data, so results are reproducible without the proprietary ITCH files. Every case
+reports messages per second (best of --repeat runs) and the peak traced memory of one extra run.
+
+    python benchmark.py --messages 200000 --save benchmarks/baseline.json
+    python benchmark.py --messages 200000 --compare benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+from agent.agent import RandomAgent
+from config import config as default_config
+from market.components import Feed
+from market.order_book import OrderBook
+from market.simulator import Simulator
+from utils import parse, parse2
+from utils.MessageHandler import Tokenizer, parse_message
+from utils.pipeline import ItchPipeline
+from utils.snapshot import record
+from utils.store import csv_to_store
+from utils.synthetic import generate_messages, write_csv, write_raw_csv, write_itch, OrderFlow
+
+
+def bench_book(data):
+    def run():
+        order_book = OrderBook()
+        for msg in data["messages"]:
+            order_book.process_message(msg)
+        return len(data["messages"])
+    return run
+
+
+def bench_flow(data):
+    def run():
+        order_book = OrderBook()
+        flow = OrderFlow(data["n"], order_book, arrival="hawkes", seed=data["seed"])
+        for msg in flow:
+            order_book.process_message(msg)
+        return len(flow)
+    return run
+
+
+def bench_feed_csv(data):
+    def run():
+        feed = Feed(data["csv"])
+        counter = 0
+        while feed.has_next():
+            feed.next()
+            counter += 1
+        return counter
+    return run
+
+
+def bench_feed_store(data):
+    def run():
+        feed = Feed(data["store"])
+        counter = 0
+        while feed.has_next():
+            feed.next()
+            counter += 1
+        return counter
+    return run
+
+
+def bench_snapshot(data):
+    # one snapshot per 10 messages on average, far denser than 100ms on a real day
+    def run():
+        messages = data["messages"]
+        interval = max(1, (messages[-1].timestamp - messages[0].timestamp) * 10 // len(messages))
+        record(messages, os.path.join(data["path"], "snapshots"), 10, interval, messages[0].timestamp,
+               messages[-1].timestamp)
+        return len(messages)
+    return run
+
+
+def bench_store(data):
+    def run():
+        csv_to_store(data["csv"], data["store_out"])
+        return len(data["messages"])
+    return run
+
+
+def bench_simulator(data):
+    def run():
+        sim = Simulator(RandomAgent(1, 1, seed=0), data["sim_store"], default_config)
+        states = sim.update_states()
+        start_counter = sim.counter
+        while sim.feed.has_next():
+            sim.counter += 1
+            states, _ = sim.step(sim.agent.act(states))
+        return sim.counter - start_counter
+    return run
+
+
+def bench_parse_itch(data):
+    def run():
+        parse2.parse_and_save(data["itch"], data["raw_out"])
+        return data["raw_count"]
+    return run
+
+
+def bench_tokenizer(data):
+    def run():
+        counter = 0
+        with Tokenizer(data["itch_gz"]) as reader:
+            while True:
+                msg = parse_message(reader.get_message())
+                counter += 1
+                if msg is not None and msg.__class__.__name__ == "SystemEvent":
+                    break
+        return counter
+    return run
+
+
+def bench_parse_split(data):
+    def run():
+        parse.parse_and_save(data["itch_gz"], data["path"])
+        return data["raw_count"]
+    return run
+
+
+def bench_pipeline(data):
+    def run():
+        with ItchPipeline(data["itch_gz"]) as pipeline:
+            return pipeline.replay(OrderBook())
+    return run
+
+
+def bench_preprocess(data):
+    def run():
+        parse2.preprocess_data(data["raw"])
+        return data["raw_count"]
+    return run
+
+
+CASES = {"book": bench_book, "flow": bench_flow, "feed_csv": bench_feed_csv, "feed_store": bench_feed_store,
+         "store": bench_store, "simulator": bench_simulator, "parse_itch": bench_parse_itch,
+         "tokenizer": bench_tokenizer, "parse_split": bench_parse_split, "pipeline": bench_pipeline,
+         "preprocess": bench_preprocess, "snapshot": bench_snapshot}
+
+
+def prepare(path, n, seed):
+    """
+    write the synthetic day in every input format
+    """
+    messages = generate_messages(n, seed=seed)
+    # the simulator generates its own algo orders, its input only has real messages
+    real = generate_messages(n, seed=seed, algo_share=0)
+    data = {"n": n, "seed": seed, "path": path, "messages": messages, "csv": os.path.join(path, "synthetic-v2.csv"),
+            "store_out": os.path.join(path, "converted.npy"), "raw": os.path.join(path, "synthetic.csv"),
+            "raw_out": os.path.join(path, "parsed.csv"), "itch": os.path.join(path, "synthetic.itch"),
+            "itch_gz": os.path.join(path, "S020117-v50.txt.gz"), "sim_csv": os.path.join(path, "real-v2.csv")}
+    write_csv(messages, data["csv"])
+    data["store"] = csv_to_store(data["csv"], os.path.join(path, "synthetic-v2.npy"))
+    write_raw_csv(messages, data["raw"])
+    data["raw_count"] = sum(1 for msg in messages if msg.ref > 0 and msg.type[0] != 'M')
+    write_itch(messages, data["itch"])
+    write_itch(messages, data["itch_gz"])
+    write_csv(real, data["sim_csv"])
+    data["sim_store"] = csv_to_store(data["sim_csv"])
+    return data
+
+
+def measure(run, repeat):
+    best, count = None, 0
+    for _ in range(repeat):
+        start = perf_counter()
+        count = run()
+        seconds = perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"messages": count, "seconds": best, "msgs_per_sec": count / best if best > 0 else 0,
+            "peak_mb": peak / 2 ** 20}
+
+
+def run_benchmarks(n=100000, seed=0, cases=None, repeat=3):
+    cases = cases or list(CASES)
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        data = prepare(path, n, seed)
+        stdout = sys.stdout
+        for name in cases:
+            print("\rBenchmark: %s" % name, end="", flush=True)
+            sys.stdout = open(os.devnull, "w")  # the replay code prints progress
+            try:
+                results[name] = measure(CASES[name](data), repeat)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+    print("\rBenchmark: finished")
+    return {"messages": n, "seed": seed, "repeat": repeat, "python": platform.python_version(),
+            "machine": platform.machine(), "results": results}
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    print both runs side by side, returns the cases that are slower than the baseline by more than tolerance
+    """
+    if report["messages"] != baseline["messages"] or report["seed"] != baseline["seed"]:
+        print("Warning: baseline was run with %d messages / seed %d" % (baseline["messages"], baseline["seed"]))
+    regressions = []
+    print("%-12s %14s %14s %8s %10s %10s" % ("case", "msgs/s", "baseline", "ratio", "peak MB", "baseline"))
+    for name, result in report["results"].items():
+        if name not in baseline["results"]:
+            print("%-12s %14.0f %14s" % (name, result["msgs_per_sec"], "-"))
+            continue
+        base = baseline["results"][name]
+        ratio = result["msgs_per_sec"] / base["msgs_per_sec"]
+        print("%-12s %14.0f %14.0f %8.2f %10.1f %10.1f" % (name, result["msgs_per_sec"], base["msgs_per_sec"], ratio,
+                                                           result["peak_mb"], base["peak_mb"]))
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay benchmarks on synthetic data")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--case", action="append", choices=list(CASES), help="run only these cases")
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--compare", help="baseline json file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.messages, args.seed, args.case, args.repeat)
+    if args.save:
+        if os.path.dirname(args.save):
+            os.makedirs(os.path.dirname(args.save), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if len(regressions) > 0:
+            print("Slower than baseline: %s" % ", ".join(regressions))
+            sys.exit(1)
+    else:
+        for name, result in report["results"].items():
+            print("%-12s %14.0f msgs/s %10.1f MB" % (name, result["msgs_per_sec"], result["peak_mb"]))
@@ -43,6 +43,15 @@ class Book:
     def get_quote_volume(self):
         return self.volumes[self.levels[0]]
 
+    def sizes(self):
+        """
+        structure sizes, tombstones are removed orders still queued in the level deques
+        """
+        queued = sum(len(level) for level in self.level_pool.values())
+        return {"orders": len(self.pool), "queued": queued, "tombstones": queued - len(self.pool),
+                "levels": len(self.levels), "volume_levels": len(self.volumes),
+                "empty_volume_levels": sum(1 for volume in self.volumes.values() if volume == 0)}
+
     def update_volume(self, price, shares):
         if price in self.volumes:
             self.volumes[price] += shares
@@ -96,26 +105,45 @@ class Book:
     def execute_market_market(self, ref, shares):
         # for message execution and market order execution
         # the function allows algo order on opposite sides
+        # a level covered by the remaining shares is swept as a whole using its volume, only the last level is
+        # executed order by order. Fills are reported for algo orders and one per level for an algo aggressor
         executed = []
         while shares > 0:
-            tmp = self.get_front_order()
-            if tmp.shares <= shares:
-                self.remove(tmp.ref)
-                shares -= tmp.shares
-                self.update_volume(tmp.price, -tmp.shares)
-                self.update_book()
-                if not tmp.real:
-                    executed.append(ExecutionInfo(tmp.ref, tmp.price, tmp.shares))
-                if ref < 0:
-                    executed.append(ExecutionInfo(ref, tmp.price, tmp.shares))
+            price = self.levels[0]
+            volume = self.volumes[price]
+            if volume <= shares:
+                for order in self.level_pool.pop(price):
+                    if order.valid:
+                        del self.pool[order.ref]
+                        order.valid = False
+                        if not order.real:
+                            executed.append(ExecutionInfo(order.ref, price, order.shares))
+                self.levels.pop(0)
+                self.volumes[price] = 0
+                self.update_book()  # levels behind may hold only deleted orders
+                filled = volume
             else:
-                tmp.shares -= shares
-                self.update_volume(tmp.price, -shares)
-                if not tmp.real:
-                    executed.append(ExecutionInfo(tmp.ref, tmp.price, shares))
-                if ref < 0:
-                    executed.append(ExecutionInfo(ref, tmp.price, shares))
-                shares = 0
+                level = self.level_pool[price]
+                filled = 0
+                while filled < shares:
+                    tmp = level[0]
+                    if not tmp.valid:
+                        level.popleft()
+                        continue
+                    size = min(tmp.shares, shares - filled)
+                    if size == tmp.shares:
+                        self.remove(tmp.ref)
+                        level.popleft()
+                    else:
+                        tmp.shares -= size
+                    if not tmp.real:
+                        executed.append(ExecutionInfo(tmp.ref, price, size))
+                    filled += size
+                self.update_volume(price, -filled)
+                self.update_book()
+            if ref < 0 and filled > 0:
+                executed.append(ExecutionInfo(ref, price, filled))
+            shares -= filled
         return executed
 
     def cancel_order(self, ref, shares):
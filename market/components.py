@@ -1,60 +1,160 @@
 
 import csv
+import heapq
 import numpy as np
-from collections import deque
+from sortedcollections import SortedDict
 from market.elements import FormattedMessage, ExecutionInfo
+from market.latency import UniformLatency
 from market.order_book import OrderBook
+from utils.archive import Archive
+from utils.server import ReplayClient
+from utils.store import MessageStore
 
 
 class Profile:
+    """
+    working orders on one side, indexed by ref and by price so that stale orders are found with a range query
+    """
     def __init__(self, ask):
         self.submitted = 0
-        self.orders = {}
+        self.orders = {}  # ref -> ExecutionInfo
+        self.levels = SortedDict()  # price -> {ref: ExecutionInfo}
         self.ask = ask
 
+    def add(self, info: ExecutionInfo):
+        self.orders[info.ref] = info
+        if info.price not in self.levels:
+            self.levels[info.price] = {}
+        self.levels[info.price][info.ref] = info
+
+    def remove(self, ref) -> ExecutionInfo:
+        info = self.orders.pop(ref)
+        level = self.levels[info.price]
+        del level[ref]
+        if len(level) == 0:
+            del self.levels[info.price]
+        return info
+
+    def reduce(self, ref, shares):
+        if self.orders[ref].shares == shares:
+            self.remove(ref)
+        else:
+            self.orders[ref].shares -= shares
+
+    def pop_outside(self, lb, ub):
+        """
+        remove and return orders priced strictly outside [lb, ub]
+        """
+        prices = list(self.levels.irange(maximum=lb, inclusive=(True, False)))
+        prices += list(self.levels.irange(minimum=ub, inclusive=(False, True)))
+        removed = []
+        for price in prices:
+            level = self.levels.pop(price)
+            for ref, info in level.items():
+                del self.orders[ref]
+                removed.append(info)
+        return removed
+
+    def clear(self):
+        removed = list(self.orders.values())
+        self.orders.clear()
+        self.levels.clear()
+        return removed
+
 
 class Feed:
-    def __init__(self, filename, delay_lb=1500, delay_ub=3000):
-        self.messages = []
-        self.pointer = 0
-        self.open_orders = deque()
+    """
+    k-way merge of timestamped message sources. The heap holds the head of every real source plus all pending algo
+    messages, so each message costs O(log k) regardless of the order algo messages are submitted in
+    """
+    ALGO = -1  # source id of the messages submitted through this feed
+
+    def __init__(self, filename, delay_lb=1500, delay_ub=3000, latency=None):
+        self.heap = []  # (timestamp, priority, seq, source, message), real messages go first on equal timestamps
+        self.sources = []  # (iterator, timestamp offset)
+        self.seq = 0
+        self.size = 0  # number of real messages in sources with known length
+        self.active = 0  # number of real sources not exhausted yet
+        self.last_source = None  # source of the last message returned by next()
         self.last_transmission_time = 0  # to simulate delayed transmission
         self.last_wall_time = 0
         self.wall_time = 0
         self.ref = -1
-        self.delay_lb = delay_lb
-        self.delay_ub = delay_ub
+        self.latency = UniformLatency(delay_lb, delay_ub) if latency is None else latency
+        self.messages = self.load(filename)
+        self.add_source(self.messages)
+
+    @staticmethod
+    def load(filename):
+        if isinstance(filename, np.ndarray) or (isinstance(filename, str) and filename.endswith(".npy")):
+            return MessageStore(filename)  # memory-mapped store, nothing to parse
+        if isinstance(filename, str) and filename.endswith(".arc"):
+            return Archive(filename).source(owned=True)  # first day of a block-compressed archive, closed once read
+        if isinstance(filename, str) and filename.startswith("unix:"):
+            return ReplayClient(filename[5:])  # subscription to a utils.server replay
+        if not isinstance(filename, str):
+            return filename  # any iterable of FormattedMessage in timestamp order
+        messages = []
         print("Feed: reading data", end='', flush=True)
         with open(filename, "r") as f:
             reader = csv.reader(f)
             for row in reader:
-                self.messages.append(FormattedMessage(row))
+                messages.append(FormattedMessage(row))
         print("\rFeed: finish parsing message data")
-        self.size = len(self.messages)
+        return messages
+
+    def add_source(self, messages, offset=0):
+        """
+        merge another real source, e.g. another symbol or another day. offset is added to its timestamps for
+        ordering, which lets consecutive days be replayed in one feed. Returns the source id
+        """
+        messages = self.load(messages)
+        if hasattr(messages, "__len__"):
+            self.size += len(messages)
+        self.sources.append((iter(messages), offset))
+        self.active += self._advance(len(self.sources) - 1)
+        return len(self.sources) - 1
+
+    def _advance(self, source):
+        iterator, offset = self.sources[source]
+        msg = next(iterator, None)
+        if msg is None:
+            return False
+        heapq.heappush(self.heap, (msg.timestamp + offset, 0, self.seq, source, msg))
+        self.seq += 1
+        return True
+
+    def push(self, msg, source=ALGO):
+        heapq.heappush(self.heap, (msg.timestamp, 1, self.seq, source, msg))
+        self.seq += 1
 
     def has_next(self):
-        return self.pointer < self.size
+        # the replay ends with the real data, algo messages still in flight are dropped
+        return self.active > 0
 
     def next(self):
-        if len(self.open_orders) > 0 and self.messages[self.pointer].timestamp > self.open_orders[0].timestamp:
-            tmp = self.open_orders.popleft()
-        else:
-            tmp = self.messages[self.pointer]
-            self.pointer += 1
-        self.wall_time = tmp.timestamp
+        timestamp, _, _, source, tmp = heapq.heappop(self.heap)
+        if source >= 0 and not self._advance(source):
+            self.active -= 1
+        self.wall_time = timestamp
+        self.last_source = source
         return tmp
 
     def time(self):
+        # messages sent at the same wall time arrive together, the heap keeps them in submission order
         if self.last_wall_time < self.wall_time:
             self.last_transmission_time = max(self.last_transmission_time,
-                                              self.wall_time + np.random.uniform(self.delay_lb, self.delay_ub))
+                                              self.wall_time + self.latency.draw())
             self.last_wall_time = self.wall_time
-        else:
-            self.last_transmission_time += 500
         return self.last_transmission_time
 
     def peek(self):
-        return self.messages[self.pointer]
+        return self.heap[0][-1]
+
+    def sizes(self):
+        # the heap holds one head per active source, the rest are algo messages in flight
+        return {"feed.heap": len(self.heap), "feed.pending": len(self.heap) - self.active,
+                "feed.sources": len(self.sources), "feed.active": self.active}
 
     def add_order(self, price, shares, ask=True):
         msg = FormattedMessage()
@@ -63,7 +163,7 @@ class Feed:
         msg.timestamp = self.time()
         msg.price = price
         msg.shares = shares
-        self.open_orders.append(msg)
+        self.push(msg)
         self.ref -= 1
         return self.ref + 1
 
@@ -73,16 +173,38 @@ class Feed:
         msg.ref = self.ref
         msg.timestamp = self.time()
         msg.shares = shares
-        self.open_orders.append(msg)
+        self.push(msg)
         self.ref -= 1
         return self.ref + 1
 
     def delete_order(self, ref, ask):
+        self.delete_orders([ref], ask)
+
+    def delete_orders(self, refs, ask):
+        if len(refs) == 0:
+            return  # nothing to send, no latency drawn
+        timestamp = self.time()
+        for ref in refs:
+            msg = FormattedMessage()
+            msg.type = 'D' + ('A' if ask else 'B')
+            msg.ref = ref
+            msg.timestamp = timestamp
+            self.push(msg)
+
+    def replace_order(self, ref, price, shares, ask):
+        """
+        re-price an algo order in one message, returns the new ref
+        """
         msg = FormattedMessage()
-        msg.type = 'D' + ('A' if ask else 'B')
+        msg.type = 'UA2' if ask else 'UB2'
         msg.ref = ref
+        msg.new_ref = self.ref
         msg.timestamp = self.time()
-        self.open_orders.append(msg)
+        msg.price = price
+        msg.shares = shares
+        self.push(msg)
+        self.ref -= 1
+        return self.ref + 1
 
 
 class SmartOrderRouter:
@@ -97,40 +219,33 @@ class SmartOrderRouter:
         self.bid_profile = Profile(ask=False)
         self.action_map = {0: (1, 1), 1: (2, 2), 2: (3, 3), 3: (4, 4), 4: (5, 5), 5: (1, 3), 6: (3, 1),
                            7: (2, 5), 8: (5, 2)}
-        self.position = 0
         self.target_size = target_size  # size to maintain on each book
         self.alpha = alpha  # liquidation percentage
         self.skip_size = skip_size  # for level re-anchoring
 
     def update_submission(self, ind, executed):
-        orders = self.bid_profile.orders if ind == "B" else self.ask_profile.orders
+        profile = self.bid_profile if ind == "B" else self.ask_profile
         queue_shares = 0
         delete_shares = 0
         for info in executed:
-            if info.ref in orders:
-                if orders[info.ref].shares == info.shares:
-                    del orders[info.ref]
-                else:
-                    orders[info.ref].shares -= info.shares
+            if info.ref in profile.orders:
+                profile.reduce(info.ref, info.shares)
                 queue_shares += info.shares
             else:
                 delete_shares += info.shares
-        if ind == "B":
-            self.bid_profile.submitted -= queue_shares
-        else:
-            self.ask_profile.submitted -= queue_shares
+        profile.submitted -= queue_shares
         return queue_shares + delete_shares
 
     def execute(self, action):
         if action == 9:
-            if self.position > 0:
-                orders, queue, ask = self.bid_profile.orders, self.ask_profile.orders, False
-            else:
-                orders, queue, ask = self.ask_profile.orders, self.bid_profile.orders, True
-            for order in orders:
-                self.feed.delete_order(order.ref, ask)
-            shares = int(self.alpha * self.position)
-            queue[self.feed.add_market_order(shares, self.position < 0)] = shares
+            position = self.env.position
+            profile = self.bid_profile if position > 0 else self.ask_profile
+            removed = profile.clear()
+            profile.submitted -= sum(info.shares for info in removed)
+            self.feed.delete_orders([info.ref for info in removed], profile.ask)
+            shares = abs(int(self.alpha * position))
+            if shares > 0:
+                self.feed.add_market_order(shares, position < 0)
         else:
             self.execute_single_book(self.action_map[action][0], self.ask_profile)
             self.execute_single_book(self.action_map[action][1], self.bid_profile)
@@ -142,19 +257,18 @@ class SmartOrderRouter:
         else:
             target_price = self.order_book.get_real_bid(action - 1)
 
-        # clear stalled orders
-        to_delete = []
-        for ref, info in profile.orders.items():
-            if abs(info.price - target_price) > self.skip_size:
-                self.feed.delete_order(ref, profile.ask)
-                profile.submitted -= info.shares
-                to_delete.append(ref)
-        for ref in to_delete:
-            del profile.orders[ref]
+        # clear stalled orders, one of them is re-priced instead of deleted if we need to refill
+        stale = profile.pop_outside(target_price - self.skip_size, target_price + self.skip_size)
+        profile.submitted -= sum(info.shares for info in stale)
 
         # refill order if needed
         if profile.submitted < self.target_size:
             shares = self.target_size - profile.submitted
-            ref = self.feed.add_order(target_price, shares, profile.ask)
-            profile.orders[ref] = ExecutionInfo(ref, target_price, shares)
+            if len(stale) > 0:
+                ref = self.feed.replace_order(stale.pop().ref, target_price, shares, profile.ask)
+            else:
+                ref = self.feed.add_order(target_price, shares, profile.ask)
+            profile.add(ExecutionInfo(ref, target_price, shares))
             profile.submitted = self.target_size
+        if len(stale) > 0:
+            self.feed.delete_orders([info.ref for info in stale], profile.ask)
@@ -11,7 +11,7 @@ class FormattedMessage:
             if self.type[0] == 'A':
                 self.price = int(raw[4])
                 self.shares = int(raw[5])
-            elif self.type[0] == 'E' or self.type[0] == 'X':
+            elif self.type[0] == 'E' or self.type[0] == 'X' or self.type[0] == 'M':
                 self.shares = int(raw[5])
             elif self.type[0] == 'U':
                 self.new_ref = int(raw[3])
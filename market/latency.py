@@ -0,0 +1,67 @@
+"""
+Latency models for algo messages. Delays are pre-drawn in blocks from a numpy Generator, so runs are reproducible
+given the seed and a single draw is only a list lookup
+"""
+import abc
+import numpy as np
+
+
+class LatencyModel:
+    def __init__(self, rng=None, block_size=4096):
+        self.rng = rng if isinstance(rng, np.random.Generator) else np.random.default_rng(rng)
+        self.block_size = block_size
+        self.block = []
+        self.idx = 0
+
+    @abc.abstractmethod
+    def draw_block(self, n) -> np.ndarray:
+        pass
+
+    def draw(self):
+        if self.idx >= len(self.block):
+            self.block = self.draw_block(self.block_size).tolist()
+            self.idx = 0
+        self.idx += 1
+        return self.block[self.idx - 1]
+
+
+class UniformLatency(LatencyModel):
+    def __init__(self, lb, ub, rng=None, block_size=4096):
+        super(UniformLatency, self).__init__(rng, block_size)
+        self.lb = lb
+        self.ub = ub
+
+    def draw_block(self, n):
+        return self.rng.uniform(self.lb, self.ub, n)
+
+
+class ExponentialLatency(LatencyModel):
+    def __init__(self, scale, offset=0, rng=None, block_size=4096):
+        super(ExponentialLatency, self).__init__(rng, block_size)
+        self.scale = scale
+        self.offset = offset  # minimum delay
+
+    def draw_block(self, n):
+        return self.offset + self.rng.exponential(self.scale, n)
+
+    @classmethod
+    def fit(cls, timestamps, cutoff=80000, offset=0, rng=None, block_size=4096):
+        """
+        fit the scale to inter-arrival times, ignoring gaps longer than cutoff as in research.py
+        """
+        deltas = np.diff(np.asarray(timestamps))
+        return cls(deltas[deltas < cutoff].mean(), offset, rng, block_size)
+
+
+class EmpiricalLatency(LatencyModel):
+    def __init__(self, samples, rng=None, block_size=4096):
+        super(EmpiricalLatency, self).__init__(rng, block_size)
+        self.samples = np.asarray(samples)
+
+    def draw_block(self, n):
+        return self.rng.choice(self.samples, n)
+
+    @classmethod
+    def fit(cls, timestamps, cutoff=80000, rng=None, block_size=4096):
+        deltas = np.diff(np.asarray(timestamps))
+        return cls(deltas[deltas < cutoff], rng, block_size)
@@ -0,0 +1,74 @@
+
+import numpy as np
+
+BUY, SELL = 1, -1
+
+
+class Ledger:
+    """
+    Position and pnl of the algo orders with average cost accounting, O(1) per fill. Every fill is also appended to a
+    columnar log for post-run analysis
+    """
+    def __init__(self, capacity=65536):
+        self.position = 0
+        self.avg_cost = 0.  # average price of the open position
+        self.realized = 0.
+        self.size = 0
+        self.counts = {BUY: 0, SELL: 0}
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.refs = np.zeros(capacity, dtype=np.int64)
+        self.sides = np.zeros(capacity, dtype=np.int8)
+        self.prices = np.zeros(capacity, dtype=np.int64)
+        self.shares = np.zeros(capacity, dtype=np.int64)
+
+    def record(self, timestamp, ind, executed):
+        side = BUY if ind == 'B' else SELL
+        for info in executed:
+            self.fill(timestamp, info.ref, side, info.price, info.shares)
+
+    def fill(self, timestamp, ref, side, price, shares):
+        if shares <= 0:  # a bad fill upstream, it would corrupt the average cost
+            raise ValueError("Fill of %d shares for order %d at %d" % (shares, ref, price))
+        if self.size == len(self.timestamps):
+            self._grow()
+        idx = self.size
+        self.timestamps[idx] = timestamp
+        self.refs[idx] = ref
+        self.sides[idx] = side
+        self.prices[idx] = price
+        self.shares[idx] = shares
+        self.size += 1
+        self.counts[side] += 1
+
+        if self.position * side >= 0:  # open or add to the position
+            held = abs(self.position)
+            self.avg_cost = (self.avg_cost * held + price * shares) / (held + shares)
+            self.position += side * shares
+        else:  # reduce, close or flip the position
+            closed = min(shares, abs(self.position))
+            self.realized += closed * (price - self.avg_cost) * -side
+            self.position += side * shares
+            if self.position == 0:
+                self.avg_cost = 0.
+            elif self.position * side > 0:  # flipped, the remaining shares are opened at this price
+                self.avg_cost = price
+
+    def _grow(self):
+        for name in ["timestamps", "refs", "sides", "prices", "shares"]:
+            old = getattr(self, name)
+            new = np.zeros(2 * len(old), dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def unrealized(self, mid_price):
+        return self.position * (mid_price - self.avg_cost)
+
+    def total(self, mid_price):
+        return self.realized + self.unrealized(mid_price)
+
+    def get_fills(self):
+        """
+        column views of the fills so far
+        """
+        return {"timestamp": self.timestamps[:self.size], "ref": self.refs[:self.size],
+                "side": self.sides[:self.size], "price": self.prices[:self.size], "shares": self.shares[:self.size]}
@@ -34,6 +34,12 @@ class OrderBook:
                 if order.real:
                     return order.price
 
+    def sizes(self):
+        sizes = {}
+        for side, book in [("ask", self.ask_book), ("bid", self.bid_book)]:
+            sizes.update({side + "." + name: value for name, value in book.sizes().items()})
+        return sizes
+
     def process_message(self, msg: FormattedMessage):
         price, shares = None, None
         if msg.type == 'AA':  # add Ask
@@ -74,6 +80,12 @@ class OrderBook:
             if msg.ref in self.bid_book:
                 self.bid_book.delete_order(msg.ref)
                 self.add_bid(msg.new_ref, msg.price, msg.shares, True)
+        elif msg.type == 'UA2':  # algo generated replace, same as delete and add
+            self.ask_book.delete_order(msg.ref)
+            return self.add_ask(msg.new_ref, msg.price, msg.shares, real=False)
+        elif msg.type == 'UB2':  # algo generated replace
+            self.bid_book.delete_order(msg.ref)
+            return self.add_bid(msg.new_ref, msg.price, msg.shares, real=False)
         else:
             print("Unrecognized message type: ", msg.type)
         return price, shares
@@ -1,21 +1,27 @@
 
-from collections import deque
-from time import clock
+from time import perf_counter
+import numpy as np
 from market.order_book import OrderBook
 from market.components import Feed, SmartOrderRouter
+from market.latency import UniformLatency
+from market.ledger import Ledger, BUY, SELL
 from utils.feature import FeatureDelta, RollingMean
 
 
 class Simulator:
-    def __init__(self, agent, filename, config):
-        self.feed = Feed(filename, delay_lb=config.delay_lb, delay_ub=config.delay_ub)
+    def __init__(self, agent, filename, config, latency=None):
+        self.rng = np.random.default_rng(config.seed)  # all randomness of the run comes from here
+        if latency is None:
+            latency = UniformLatency(config.delay_lb, config.delay_ub, rng=self.rng)
+        self.feed = Feed(filename, latency=latency)
         self.order_book = OrderBook()  # SimulationBook allow algo generated orders
+        if hasattr(self.feed.messages, "attach"):
+            self.feed.messages.attach(self.order_book)  # generated source, e.g. utils.synthetic.OrderFlow
         self.agent = agent
         self.config = config
         self.default_features = ["MSPD50"]
-        self.open_buys, self.open_sells = deque(), deque()
-        self.position = 0
-        self.pnl = 0
+        self.ledger = Ledger()
+        self.marked_pnl = 0  # realized + unrealized pnl after the last step
         self.counter = 0
         self.build_book()
         self.init_features()
@@ -23,6 +29,19 @@ class Simulator:
         self.SOR = SmartOrderRouter(self.feed, self.order_book, self, config.target_size, config.liquidation_rate,
                                     config.skip_size)
 
+    @property
+    def position(self):
+        return self.ledger.position
+
+    @property
+    def pnl(self):
+        return self.ledger.realized
+
+    @property
+    def fills(self):
+        # number of executions on each side
+        return {'B': self.ledger.counts[BUY], 'S': self.ledger.counts[SELL]}
+
     def build_book(self):
         """
         At the beginning of the day, Nasdaq will populate the whole book by sending "add" message
@@ -33,6 +52,16 @@ class Simulator:
             self.counter += 1
         print("\rBuild: finish building book")
 
+    def sizes(self):
+        """
+        structure sizes of the book, the feed and the working algo orders, see utils.profiler.MemoryMonitor
+        """
+        sizes = self.order_book.sizes()
+        sizes.update(self.feed.sizes())
+        sizes.update({"sor.ask_orders": len(self.SOR.ask_profile.orders),
+                      "sor.bid_orders": len(self.SOR.bid_profile.orders)})
+        return sizes
+
     def init_features(self):
         # initialize features
         for name in set(self.config.features + self.default_features):
@@ -43,17 +72,37 @@ class Simulator:
                 alpha = float(name[4:]) / 100
                 self.rspd = RollingMean(alpha)
 
-    def run_simulation(self):
+    def fast_forward(self, n):
+        """
+        replay n messages without acting, e.g. to start several environments at different points of the same day
+        """
+        for _ in range(n):
+            if not self.feed.has_next():
+                break
+            self.order_book.process_message(self.feed.next())
+            self.counter += 1
+        return self.update_states()
+
+    def run_simulation(self, replay=None):
+        """
+        transitions are recorded into replay (a ReplayBuffer) if given
+        """
         states = self.update_states()
-        start = clock()
+        start = perf_counter()
         while self.feed.has_next():
             self.counter += 1
             action = self.agent.act(states)
-            states, reward = self.step(action)
+            next_states, reward = self.step(action)
+            if replay is not None:
+                replay.append(states, action, reward, next_states, not self.feed.has_next())
+            states = next_states
             if self.counter % 10000 == 0:
                 print("pnl: %.2f / position: %d" % (self.pnl / 10000, self.position))
-        print("%ds / %d records (%.2f)" % (clock() - start, self.counter - len(self.feed.messages),
-                                           self.counter / len(self.feed.messages) * 100 ))
+        if self.feed.size > 0:
+            print("%ds / %d records (%.2f)" % (perf_counter() - start, self.counter - self.feed.size,
+                                               self.counter / self.feed.size * 100))
+        else:  # unsized source, e.g. a generator
+            print("%ds / %d messages" % (perf_counter() - start, self.counter))
 
     def update_states(self):
         states = []
@@ -83,21 +132,11 @@ class Simulator:
 
         # netting
         if ind is not None:
-            shares_to_add = self.SOR.update_submission(ind, executed)  # reduce submission by the same amount
-            if ind == 'B':
-                self.open_buys.extend(executed)
-            else:
-                self.open_sells.extend(executed)
-            while len(self.open_buys) > 0 and len(self.open_sells) > 0:
-                if self.open_buys[0].shares == self.open_sells[0].shares:
-                    self.pnl += self.open_buys[0].shares * (self.open_sells[0].price - self.open_buys[0].price)
-                    self.open_buys.popleft()
-                    self.open_sells.popleft()
-                elif self.open_buys[0].shares > self.open_sells[0].shares:
-                    self.pnl += self.open_sells[0].shares * (self.open_sells[0].price - self.open_buys[0].price)
-                    self.open_sells.popleft()
-                else:
-                    self.pnl += self.open_buys[0].shares * (self.open_sells[0].price - self.open_buys[0].price)
-                    self.open_buys.popleft()
-            self.position += shares_to_add if ind == 'B' else -shares_to_add
-        return self.update_states(), 0
+            self.SOR.update_submission(ind, executed)  # reduce submission by the same amount
+            self.ledger.record(self.feed.wall_time, ind, executed)
+
+        # reward is the change of pnl marked to the mid price
+        marked_pnl = self.ledger.total(self.order_book.get_mid_price())
+        reward = marked_pnl - self.marked_pnl
+        self.marked_pnl = marked_pnl
+        return self.update_states(), reward
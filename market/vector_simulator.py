@@ -0,0 +1,158 @@
+"""
+Batch of simulators stepped together, so that a batched policy is evaluated once per step instead of once per env
+"""
+import multiprocessing as mp
+import traceback
+from multiprocessing import shared_memory
+import numpy as np
+from market.simulator import Simulator
+
+
+def _worker(idx, filename, config, offset, shm_name, shape, conn):
+    """
+    owns one simulator and writes [states..., reward, done] into its row of the shared buffer after every step.
+    Replies None when done, ("error", traceback) if the simulator failed
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffer = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    try:
+        sim = Simulator(None, filename, config)
+        buffer[idx, :-2] = sim.fast_forward(offset)
+        buffer[idx, -1] = not sim.feed.has_next()
+        conn.send(None)  # ready
+        while True:
+            action = conn.recv()
+            if action is None:
+                break
+            if buffer[idx, -1] == 0:
+                states, reward = sim.step(action)
+                buffer[idx, :-2] = states
+                buffer[idx, -2] = reward
+                buffer[idx, -1] = not sim.feed.has_next()
+            else:
+                buffer[idx, -2] = 0
+            conn.send(None)
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        del buffer
+        shm.close()
+        conn.close()
+
+
+def _receive(conn):
+    try:
+        reply = conn.recv()
+    except EOFError:
+        raise RuntimeError("Simulator worker exited unexpectedly")
+    if reply is not None:
+        raise RuntimeError("Simulator worker failed:\n" + reply[1])
+
+
+class VectorSimulator:
+    def __init__(self, filenames, configs, offsets=None, workers=False):
+        """
+        filenames, configs and offsets are given per environment. A single config is shared by all environments and
+        offsets are the number of messages to replay before the first action. With workers=True every environment
+        lives in its own process and the states come back through a shared memory buffer
+        """
+        self.num_envs = len(filenames)
+        if not isinstance(configs, list):  # ConfigClass itself is a tuple
+            configs = [configs] * self.num_envs
+        if offsets is None:
+            offsets = [0] * self.num_envs
+        self.num_features = len(configs[0].features)
+        if any(len(config.features) != self.num_features for config in configs):
+            raise ValueError("All environments should have the same number of features")
+        self.workers = workers
+        self.shape = (self.num_envs, self.num_features + 2)
+        self.shm = None
+        if workers:
+            self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)) * 8)
+            self.buffer = np.ndarray(self.shape, dtype=np.float64, buffer=self.shm.buf)
+            self.buffer[:] = 0
+            self.conns, self.processes = [], []
+            try:
+                for idx in range(self.num_envs):
+                    parent, child = mp.Pipe()
+                    process = mp.Process(target=_worker, args=(idx, filenames[idx], configs[idx], offsets[idx],
+                                                               self.shm.name, self.shape, child), daemon=True)
+                    process.start()
+                    child.close()  # only the worker holds it, so recv sees EOF if the worker dies
+                    self.conns.append(parent)
+                    self.processes.append(process)
+                for conn in self.conns:
+                    _receive(conn)
+            except BaseException:
+                self.close()
+                raise
+        else:
+            self.buffer = np.zeros(self.shape)
+            self.sims = [Simulator(None, filename, config) for filename, config in zip(filenames, configs)]
+            for idx, sim in enumerate(self.sims):
+                self.buffer[idx, :-2] = sim.fast_forward(offsets[idx])
+                self.buffer[idx, -1] = not sim.feed.has_next()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def states(self):
+        return self.buffer[:, :-2].copy()
+
+    @property
+    def dones(self):
+        return self.buffer[:, -1] != 0
+
+    def step(self, actions):
+        """
+        actions is an array of size num_envs. Finished environments ignore their action, keep their last states and
+        get zero reward. Returns (states, rewards, dones) as arrays
+        """
+        actions = np.asarray(actions)
+        if self.workers:
+            for conn, action in zip(self.conns, actions.tolist()):
+                conn.send(action)
+            for conn in self.conns:
+                _receive(conn)
+        else:
+            for idx, (sim, action) in enumerate(zip(self.sims, actions.tolist())):
+                if self.buffer[idx, -1] == 0:
+                    states, reward = sim.step(action)
+                    self.buffer[idx, :-2] = states
+                    self.buffer[idx, -2] = reward
+                    self.buffer[idx, -1] = not sim.feed.has_next()
+                else:
+                    self.buffer[idx, -2] = 0
+        return self.states, self.buffer[:, -2].copy(), self.dones
+
+    def run(self, policy):
+        """
+        policy maps a (num_envs, num_features) state array to an array of actions. Returns total reward per env
+        """
+        total = np.zeros(self.num_envs)
+        states = self.states
+        while not self.dones.all():
+            states, rewards, dones = self.step(policy(states))
+            total += rewards
+        return total
+
+    def close(self):
+        if self.workers and self.shm is not None:
+            for conn in self.conns:
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass  # the worker has already exited
+                conn.close()
+            for process in self.processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+            del self.buffer
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
@@ -1,22 +1,18 @@
-
-from market.simulator import Feed
-import pandas as pd
+from market.latency import ExponentialLatency
+from utils.stats import collect, QuantileSketch
 import numpy as np
 from matplotlib import pyplot as plt
 
-feed = Feed("data/AAPL-20170102.csv")
-
-prev_timestamp = None
-output = []
-while feed.has_next():
-    order = feed.next()
-    if 342E11 < order.timestamp < 576E11:
-        if prev_timestamp is not None:
-            output.append(order.timestamp - prev_timestamp)
-        prev_timestamp = order.timestamp
+# inter-arrival times of the market hours below the cutoff of ExponentialLatency.fit, one pass with fixed memory
+stats = collect("data/AAPL-20170102.csv", with_book=False, start=342E11, end=576E11, max_gap=80000)
+observed = stats.total().gaps
+print(observed.to_dict())
 
-output = [x for x in output if x < 80000]
-sim = np.random.exponential(19500, len(output))
-print(np.mean(output))
-pd.DataFrame({'delta': output, "sim": sim}).plot.hist(bins=1000)
+sim = QuantileSketch()
+sim.add_many(ExponentialLatency(observed.mean(), rng=0).draw_block(observed.count))
+quantiles = np.linspace(0.01, 0.99, 99)
+plt.plot([observed.quantile(q) for q in quantiles], [sim.quantile(q) for q in quantiles], ".")
+plt.plot([0, observed.quantile(0.99)], [0, observed.quantile(0.99)])
+plt.xlabel("observed")
+plt.ylabel("exponential")
 plt.show()
@@ -0,0 +1,143 @@
+"""
+Parameter sweep over ConfigClass fields. Simulations are fanned out over a process pool and every worker shares the
+same memory-mapped day of data. Each finished run is appended to the result table straight away, so an interrupted
+sweep picks up where it stopped when re-run with the same output file.
+
+    python sweep.py data/AAPL-20170102-v2.csv --param "liquidation_rate=[0.1, 0.3]" --param "target_size=[100, 200]"
+    python sweep.py data/AAPL-20170102-v2.csv --samples 20 --param "delay_lb=(5000, 20000)" --workers 8
+"""
+import argparse
+import ast
+import csv
+import hashlib
+import itertools
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+import numpy as np
+from agent.agent import RandomAgent
+from config import config as default_config
+from market.simulator import Simulator
+from utils.store import csv_to_store, load_store
+
+RESULT_FIELDS = ["run_id", "params", "pnl", "position", "buy_fills", "sell_fills", "messages", "seconds",
+                 "throughput", "error"]
+
+_store = None  # memory-mapped message store of the current worker
+
+
+def grid_search(space):
+    """
+    space maps config field -> list of candidate values
+    """
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+
+
+def random_search(space, n, seed=None):
+    """
+    space maps config field -> (lb, ub) range or list of candidate values. Integer ranges are sampled as integers
+    """
+    rng = np.random.default_rng(seed)
+    samples = []
+    for _ in range(n):
+        params = {}
+        for name in sorted(space):
+            spec = space[name]
+            if isinstance(spec, tuple):
+                if isinstance(spec[0], int) and isinstance(spec[1], int):
+                    params[name] = int(rng.integers(spec[0], spec[1] + 1))
+                else:
+                    params[name] = float(rng.uniform(spec[0], spec[1]))
+            else:
+                params[name] = spec[rng.integers(len(spec))]
+        samples.append(params)
+    return samples
+
+
+def get_run_id(params):
+    return hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def init_worker(store_path):
+    global _store
+    _store = load_store(store_path)
+
+
+def run_one(params):
+    result = {"run_id": get_run_id(params), "params": json.dumps(params, sort_keys=True), "error": ""}
+    try:
+        config = default_config._replace(**params)
+        sim = Simulator(RandomAgent(1, 1, seed=config.seed), _store, config)
+        start_counter = sim.counter
+        start = perf_counter()
+        sim.run_simulation()
+        seconds = perf_counter() - start
+        result.update(pnl=sim.pnl, position=sim.position, buy_fills=sim.fills['B'], sell_fills=sim.fills['S'],
+                      messages=sim.counter - start_counter, seconds=seconds,
+                      throughput=(sim.counter - start_counter) / seconds if seconds > 0 else 0)
+    except Exception:
+        result["error"] = traceback.format_exc(limit=1).strip().splitlines()[-1]
+    return result
+
+
+def read_finished(outfile):
+    if not os.path.exists(outfile):
+        return set()
+    with open(outfile, "r") as f:
+        return {row["run_id"] for row in csv.DictReader(f) if row["error"] == ""}
+
+
+def run_sweep(filename, candidates, outfile, workers=None):
+    """
+    run all candidate parameter sets on one day of data and collect the results in outfile (csv)
+    """
+    store_path = csv_to_store(filename) if filename.endswith(".csv") else filename
+    finished = read_finished(outfile)
+    todo = [params for params in candidates if get_run_id(params) not in finished]
+    print("Sweep: %d runs / %d already finished" % (len(todo), len(candidates) - len(todo)))
+
+    new_file = not os.path.exists(outfile)
+    with open(outfile, "a", newline="") as f, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(store_path,)) as pool:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        if new_file:
+            writer.writeheader()
+        futures = [pool.submit(run_one, params) for params in todo]
+        for count, future in enumerate(as_completed(futures), 1):
+            writer.writerow(future.result())
+            f.flush()  # a finished run is never lost when the sweep is interrupted
+            print("\rSweep: %d / %d" % (count, len(todo)), end='', flush=True)
+    print("\rSweep: finished")
+    return outfile
+
+
+def parse_space(params):
+    space = {}
+    for param in params:
+        name, value = param.split("=", 1)
+        if name not in default_config._fields:
+            raise ValueError("Unknown config field: %s" % name)
+        space[name] = ast.literal_eval(value)
+    return space
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parameter sweep over config fields")
+    parser.add_argument("filename", help="tagged message csv or .npy message store")
+    parser.add_argument("--param", action="append", default=[],
+                        help="field=[v1, v2] for candidates or field=(lb, ub) for a random search range")
+    parser.add_argument("--samples", type=int, default=None, help="number of random samples, grid search if omitted")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--out", default="sweep.csv")
+    args = parser.parse_args()
+
+    space = parse_space(args.param)
+    if args.samples is None:
+        candidates = grid_search(space)
+    else:
+        candidates = random_search(space, args.samples, args.seed)
+    run_sweep(args.filename, candidates, args.out, args.workers)
@@ -1,14 +1,42 @@
 
 import unittest
+import asyncio
 import csv
+import functools
+import os
+import tempfile
+import threading
 import time
+import types
 from market.order_book import OrderBook, FormattedMessage
+from market.elements import ExecutionInfo
 from utils.sutton import MonteCarloTester, TilingsValueFunction
-from agent.value import TileCodingValueFunction, StateSpec
+from agent.value import TileCodingValueFunction, HashedTileCodingValueFunction, ActionValueFunction, StateSpec
+from utils.store import csv_to_store, MessageStore, MESSAGE_DTYPE, to_record
+from utils.archive import Archive, write_archive
+from utils.synthetic import SyntheticStream, OrderFlow, generate_messages, write_itch, write_csv
+from utils.checks import validate_file, check_invariants, is_crossed
+from utils.writer import BufferedWriters, FilePool
+from utils import parse
+from utils.pipeline import ItchPipeline
+from utils.server import ReplayServer, ReplayClient
+from utils.stats import QuantileSketch, MarketStats
+from utils.profiler import Profiler, MemoryMonitor
+from utils.snapshot import record, load_snapshots
+from market.components import Feed, Profile, SmartOrderRouter
+from market.ledger import Ledger, BUY, SELL
+from market.latency import UniformLatency, ExponentialLatency, EmpiricalLatency
+from agent.agent import RandomAgent, GreedyAgent
+from market.simulator import Simulator
+from market.vector_simulator import VectorSimulator
+from config import config as default_config
+from agent.replay import ReplayBuffer
+from agent.shared import train_hogwild, load_checkpoint
 import numpy as np
 
 
 class TestOrderBook(unittest.TestCase):
+    @unittest.skipUnless(os.path.exists("data/AAPL-20170102-v2.csv"), "AAPL data not available")
     def test_aapl_run(self):
         # use AAPL data for testing
         filename = "data/AAPL-20170102-v2.csv"
@@ -16,12 +44,12 @@ class TestOrderBook(unittest.TestCase):
         with open(filename, "r") as f:
             reader = csv.reader(f)
             order_book = OrderBook()
-            start = time.clock()
+            start = time.perf_counter()
             counter = 0
             for row in reader:
                 counter += 1
                 order_book.process_message(FormattedMessage(row))
-        self.assertLessEqual(time.clock() - start, 14)
+        self.assertLessEqual(time.perf_counter() - start, 14)
         self.assertEqual(counter, 1733483)
         self.assertEqual(len(order_book.ask_book.pool), 0)
         self.assertEqual(len(order_book.ask_book.level_pool), 0)
@@ -30,6 +58,202 @@ class TestOrderBook(unittest.TestCase):
         self.assertEqual(len(order_book.ask_book.volumes), 1876)
         self.assertEqual(len(order_book.bid_book.volumes), 3175)
 
+    def test_synthetic_run(self):
+        # the generator tracks the book it describes, the replayed book must end in the same state
+        stream = SyntheticStream(seed=0)
+        order_book = OrderBook()
+        for msg in stream.initial_book() + stream.generate(50000):
+            order_book.process_message(msg)
+        for ask, book in [(True, order_book.ask_book), (False, order_book.bid_book)]:
+            orders = {ref: order for ref, order in stream.orders.items() if order[0] == ask}
+            self.assertEqual(set(book.pool), set(orders))
+            self.assertTrue(all(book.pool[ref].shares == order[2] for ref, order in orders.items()))
+            volumes = {}
+            for order in orders.values():
+                volumes[order[1]] = volumes.get(order[1], 0) + order[2]
+            self.assertEqual({price: volume for price, volume in book.volumes.items() if volume > 0}, volumes)
+
+    def test_order_flow(self):
+        order_book = OrderBook()
+        flow = OrderFlow(20000, order_book, arrival="hawkes", seed=0)
+        feed = Feed(flow)
+        self.assertEqual(feed.size, len(flow))
+        counter = 0
+        while feed.has_next():
+            order_book.process_message(feed.next())
+            counter += 1
+            self.assertLess(order_book.get_bid(), order_book.get_ask())
+        self.assertEqual(counter, len(flow))
+        for book in [order_book.ask_book, order_book.bid_book]:
+            self.assertTrue(all(volume >= 0 for volume in book.volumes.values()))
+            self.assertLessEqual(len(book.pool), flow.max_orders)
+
+    def test_thin_order_flow(self):
+        # the Feed pulls a message before the previous one is processed, executes must not empty a thin book
+        for seed in range(10):
+            order_book = OrderBook()
+            feed = Feed(OrderFlow(2000, order_book, depth=2, max_orders=6, execute_ratio=0.4, seed=seed))
+            while feed.has_next():
+                order_book.process_message(feed.next())
+                self.assertFalse(is_crossed(order_book))
+            self.assertEqual(check_invariants(order_book), [])
+
+    def test_level_sweep(self):
+        # sweeping whole levels must leave the book as executing one order at a time does
+        def execute_one_by_one(book, ref, shares):
+            executed = []
+            while shares > 0:
+                tmp = book.get_front_order()
+                size = min(tmp.shares, shares)
+                if size == tmp.shares:
+                    book.remove(tmp.ref)
+                else:
+                    tmp.shares -= size
+                book.update_volume(tmp.price, -size)
+                book.update_book()
+                if not tmp.real:
+                    executed.append(ExecutionInfo(tmp.ref, tmp.price, size))
+                if ref < 0:
+                    executed.append(ExecutionInfo(ref, tmp.price, size))
+                shares -= size
+            return executed
+
+        def totals(executed):
+            fills = {}
+            for info in executed:
+                fills[(info.ref, info.price)] = fills.get((info.ref, info.price), 0) + info.shares
+            return fills
+
+        sweep, reference = OrderBook(), OrderBook()
+        for book in [reference.ask_book, reference.bid_book]:
+            book.execute_market_market = lambda ref, shares, book=book: execute_one_by_one(book, ref, shares)
+        stream = SyntheticStream(algo_share=0.3, seed=0)
+        rng = np.random.default_rng(0)
+        messages = stream.initial_book() + stream.generate(20000)
+        for i, msg in enumerate(messages):
+            if i % 50 == 49:  # large market order, by an algo when the ref is negative
+                buy = bool(rng.random() < 0.5)
+                book = reference.bid_book if buy else reference.ask_book
+                msg = FormattedMessage()
+                msg.type, msg.ref, msg.timestamp = "MB" if buy else "MS", int(rng.choice([-1, 1]) * (i + 1)), 0
+                msg.shares = int(min(rng.integers(100, 5000), sum(book.volumes.values()) - 100))
+            results = [sweep.process_message(msg), reference.process_message(msg)]
+            if isinstance(results[0][1], list):
+                self.assertEqual(results[0][0], results[1][0])
+                self.assertEqual(totals(results[0][1]), totals(results[1][1]))
+        for book, expected in [(sweep.ask_book, reference.ask_book), (sweep.bid_book, reference.bid_book)]:
+            self.assertEqual(list(book.levels), list(expected.levels))
+            self.assertEqual(dict(book.volumes), dict(expected.volumes))
+            self.assertEqual({ref: order.shares for ref, order in book.pool.items()},
+                             {ref: order.shares for ref, order in expected.pool.items()})
+
+        # a swept level can uncover one whose orders were all deleted, it must be skipped without a fill
+        for shares, quote, fills in [(100, (102, 100), [(-5, 100, 100)]),
+                                     (150, (102, 50), [(-5, 100, 100), (-5, 102, 50)])]:
+            book = OrderBook().ask_book
+            for ref, price in [(1, 100), (2, 101), (3, 102)]:
+                book.add_order(ref, price, 100)
+            book.delete_order(2)
+            executed = book.execute_market_market(-5, shares)
+            self.assertEqual([(info.ref, info.price, info.shares) for info in executed], fills)
+            self.assertEqual((book.get_quote(), book.get_quote_volume()), quote)
+            ledger = Ledger()
+            ledger.record(0, 'B', executed)
+            self.assertEqual(ledger.position, shares)
+
+
+class TestChecks(unittest.TestCase):
+    def test_validate(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, "SYN-20170102-v2.csv")
+            write_csv(generate_messages(3000, seed=0), filename)
+            result = validate_file(filename, sample_every=100)
+        self.assertEqual(result["exception"], "")
+        self.assertEqual(result["mismatches"], 0)
+        self.assertEqual(result["messages"], 3060)
+        self.assertEqual(result["checks"], 31)
+
+    def test_invariants(self):
+        order_book = OrderBook()
+        for msg in generate_messages(1000, seed=0):
+            order_book.process_message(msg)
+        self.assertEqual(check_invariants(order_book), [])
+        order_book.ask_book.level_pool[order_book.get_ask()][-1].shares += 100
+        order_book.bid_book.volumes[1] = -100
+        self.assertEqual(len(check_invariants(order_book)), 2)
+
+
+class TestMemoryMonitor(unittest.TestCase):
+    def test_sizes(self):
+        order_book = OrderBook()
+        messages = generate_messages(3000, seed=0)
+        with MemoryMonitor(every=100).attach(order_book) as monitor:
+            for msg in messages:
+                order_book.process_message(msg)
+            sizes = monitor.sample()
+            with self.assertRaises(RuntimeError):
+                monitor.limits = {"ask.orders": 0}
+                monitor.sample()
+        self.assertNotIn("process_message", vars(order_book))
+        self.assertEqual(len(monitor.samples), len(messages) // 100 + 2)
+        for side, book in [("ask", order_book.ask_book), ("bid", order_book.bid_book)]:
+            self.assertEqual(sizes[side + ".orders"], len(book.pool))
+            self.assertEqual(sizes[side + ".queued"], sizes[side + ".orders"] + sizes[side + ".tombstones"])
+            self.assertGreaterEqual(monitor.high[side + ".orders"][0], sizes[side + ".orders"])
+
+    def test_stacked(self):
+        # detaching restores the attribute the wrapper replaced, a profiler attached before keeps running
+        order_book = OrderBook()
+        messages = generate_messages(2000, seed=0)
+        profiler = Profiler().attach(order_book)
+        monitor = MemoryMonitor(every=100).attach(order_book)
+        for msg in messages[:1000]:
+            order_book.process_message(msg)
+        monitor.detach()
+        monitor.detach()  # twice is fine
+        for msg in messages[1000:]:
+            order_book.process_message(msg)
+        self.assertEqual(monitor.counter, 1000)
+        self.assertEqual(sum(hist.count for hist in profiler.stats.values()), len(messages))
+        profiler.detach()
+        self.assertNotIn("process_message", vars(order_book))
+
+
+class TestSnapshots(unittest.TestCase):
+    def test_record(self):
+        # executes leave emptied levels behind the quote, a snapshot only shows levels with orders
+        order_book = OrderBook()
+        feed = Feed(OrderFlow(3000, order_book, execute_ratio=0.3, seed=0))
+        messages = []
+        while feed.has_next():
+            messages.append(feed.next())
+            order_book.process_message(messages[-1])
+        interval, start = 1000000, messages[0].timestamp + 1
+        end = messages[-1].timestamp + 3 * interval
+        with tempfile.TemporaryDirectory() as folder:
+            record(messages, folder, 3, interval, start, end)
+            columns = {name: np.array(column) for name, column in load_snapshots(folder).items()}
+        self.assertEqual(len(columns["timestamp"]), -(-(end - start) // interval))
+        self.assertTrue((columns["timestamp"] == start + interval * np.arange(len(columns["timestamp"]))).all())
+        # the snapshot at t is the book after the messages before t, rebuilt here from the resting orders
+        order_book, i = OrderBook(), 0
+        for row, timestamp in enumerate(columns["timestamp"]):
+            while i < len(messages) and messages[i].timestamp < timestamp:
+                order_book.process_message(messages[i])
+                i += 1
+            for side, book, best in [("ask", order_book.ask_book, min), ("bid", order_book.bid_book, max)]:
+                resting = {}
+                for order in book.pool.values():
+                    resting[order.price] = resting.get(order.price, 0) + order.shares
+                prices, volumes = [], []
+                while len(resting) > 0 and len(prices) < 3:
+                    price = best(resting)
+                    prices.append(price)
+                    volumes.append(resting.pop(price))
+                padding = [0] * (3 - len(prices))
+                self.assertEqual(list(columns[side + "_price"][row]), prices + padding)
+                self.assertEqual(list(columns[side + "_volume"][row]), volumes + padding)
+
 
 class TestTilingValueFunction(unittest.TestCase):
     def test_monte_carlo(self):
@@ -39,6 +263,661 @@ class TestTilingValueFunction(unittest.TestCase):
         tester.train(300)
         self.assertLessEqual(np.mean(np.abs(tester.errs[0][100:] - tester.errs[1][100:])), 0.0002)
 
+    def test_monte_carlo_batch(self):
+        funcs = [TileCodingValueFunction([StateSpec(lb=0, ub=1000, num_of_tiles=5)], 50),
+                 TilingsValueFunction(50, 200, 4)]
+        tester = MonteCarloTester(funcs, 1001)
+        tester.train_batch(30, 1000, seed=0)
+        self.assertLessEqual(np.mean(np.abs(tester.errs[0][10:] - tester.errs[1][10:])), 0.0002)
+        self.assertLessEqual(tester.errs[0][-1], 0.1)
+
+    def test_batch_update(self):
+        specs = [StateSpec(lb=0, ub=10, num_of_tiles=4), StateSpec(lb=-5, ub=5, num_of_tiles=3)]
+        single, batch = TileCodingValueFunction(specs), TileCodingValueFunction(specs)
+        states = np.random.default_rng(0).uniform([0, -5], [10, 5], size=(200, 2))
+        states[::3] = states[0]  # repeated states must receive every update
+        deltas = np.linspace(-1, 1, len(states))
+        for state, delta in zip(states, deltas):
+            single.update_value(state, delta)
+        batch.update_values(states, deltas)
+        np.testing.assert_allclose(batch.get_values(states), [single.get_value(state) for state in states])
+
+    def test_hashed(self):
+        specs = [StateSpec(lb=0, ub=10, num_of_tiles=4), StateSpec(lb=-5, ub=5, num_of_tiles=3)]
+        states = np.random.default_rng(0).uniform([0, -5], [10, 5], size=(500, 2))
+        deltas = np.linspace(-1, 1, len(states))
+        dense = TileCodingValueFunction(specs)
+        dense.update_values(states, deltas)
+        for hashing in ["iht", "modular"]:
+            # with enough memory, hashing only renames the tiles
+            func = HashedTileCodingValueFunction(specs, memory_size=1 << 20, hashing=hashing)
+            func.update_values(states, deltas)
+            np.testing.assert_allclose(func.get_values(states), dense.get_values(states))
+            self.assertEqual(func.get_stats()["overflows" if hashing == "iht" else "collisions"], 0)
+            self.assertEqual(func.get_stats()["used"], np.count_nonzero(dense.values))
+        small = HashedTileCodingValueFunction(specs, memory_size=16)
+        small.update_values(states, deltas)
+        self.assertEqual(small.values.shape, (16,))
+        self.assertGreater(small.get_stats()["collisions"], 0)
+        small = HashedTileCodingValueFunction(specs, memory_size=16, hashing="iht")
+        small.update_values(states, deltas)
+        self.assertEqual(small.get_stats()["used"], 16)
+        self.assertGreater(small.get_stats()["overflows"], 0)
+        self.assertNotIn("collisions", small.get_stats())
+
+
+HOGWILD_SPECS = [StateSpec(lb=0, ub=10, num_of_tiles=4), StateSpec(lb=-5, ub=5, num_of_tiles=3)]
+
+
+def make_hashed_function(hashing="modular"):
+    return HashedTileCodingValueFunction(HOGWILD_SPECS, memory_size=1 << 12, hashing=hashing)
+
+
+def hogwild_worker(func, seed, checkpoint=None):
+    states = np.random.default_rng(seed).uniform([0, -5], [10, 5], size=(200, 2))
+    for state in states:
+        func.update_value(state, 1.)
+    if checkpoint is not None:  # keep running until a periodic checkpoint was written
+        deadline = time.monotonic() + 10
+        while not os.path.exists(checkpoint) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if not os.path.exists(checkpoint):
+            raise RuntimeError("No checkpoint while running")
+
+
+class TestHogwild(unittest.TestCase):
+    def test_train(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, "weights.npy")
+            func = train_hogwild(make_hashed_function, functools.partial(hogwild_worker, checkpoint=filename),
+                                 num_workers=2, filename=filename, checkpoint_every=0.05)
+            loaded = load_checkpoint(make_hashed_function(), filename)
+            np.testing.assert_array_equal(loaded.values, func.values)
+            self.assertFalse(loaded.values.flags.writeable)
+            del loaded
+        # 2 workers x 200 updates of 1 spread over the tilings, lock-free updates may lose a few
+        self.assertLessEqual(func.values.sum(), 400 + 1E-6)
+        self.assertGreater(func.values.sum(), 360)
+
+    def test_iht_rejected(self):
+        func = make_hashed_function("iht")
+        with self.assertRaises(ValueError):
+            func.attach_values(np.zeros_like(func.values))
+        with self.assertRaises(ValueError):
+            train_hogwild(functools.partial(make_hashed_function, "iht"), hogwild_worker, num_workers=1)
+
+
+class TestActionValueFunction(unittest.TestCase):
+    def test_td_update(self):
+        specs = [StateSpec(lb=0, ub=10, num_of_tiles=4), StateSpec(lb=0, ub=10, num_of_tiles=4)]
+        q = ActionValueFunction(specs, num_actions=3)
+        state, next_state, far = np.array([2., 3.]), np.array([6., 6.]), np.array([9.5, 9.5])
+        errors = q.td_update([state], [1], [1.], [next_state], [True], alpha=0.5)
+        np.testing.assert_allclose(errors, [1.])
+        np.testing.assert_allclose(q.get_value(state), [0, 0.5, 0])  # only the chosen action moves
+        np.testing.assert_allclose(q.get_value(far), [0, 0, 0])
+        for _ in range(50):
+            q.td_update([state], [1], [1.], [next_state], [True], alpha=0.5)
+        self.assertAlmostEqual(q.get_value(state)[1], 1.)
+        # not done, the target bootstraps from the best action of the next state
+        q.update_value(next_state, 2, 4.)
+        errors = q.td_update([state], [0], [0.], [next_state], [False], alpha=1., gamma=0.5)
+        np.testing.assert_allclose(errors, [2.])
+        np.testing.assert_allclose(q.get_value(state), [2., 1., 0.], atol=1E-9)
+
+    def test_greedy(self):
+        specs = [StateSpec(lb=0, ub=10, num_of_tiles=4), StateSpec(lb=0, ub=10, num_of_tiles=4)]
+        q = ActionValueFunction(specs, num_actions=3)
+        agent = GreedyAgent(2, 3, q, epsilon=0.)
+        states = np.array([[2., 3.], [8., 8.]])
+        self.assertEqual(agent.act(states[0]), 0)  # all equal, the first action wins
+        q.update_value(states[0], 1, 1.)
+        q.update_value(states[0], 2, 1.)
+        self.assertEqual(agent.act(states[0]), 1)  # ties go to the lowest action
+        q.update_value(states[1], 2, 3.)
+        self.assertEqual(agent.act_batch(states).tolist(), [1, 2])
+        explore = [GreedyAgent(2, 3, q, epsilon=1., seed=0, block_size=4) for _ in range(2)]
+        self.assertEqual([explore[0].act(states[0]) for _ in range(20)], [explore[1].act(states[0]) for _ in range(20)])
+
+
+class TestMessageStore(unittest.TestCase):
+    def test_round_trip(self):
+        rows = [["AA", "1", "100", "0", "1000", "200"], ["EA", "1", "101", "55", "", "50"],
+                ["XA", "1", "102", "", "", "50"], ["UA", "1", "103", "2", "1100", "100"], ["DA", "2", "104", "", "", ""],
+                ["MB", "-1", "105", "", "", "100"]]
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, "test-v2.csv")
+            with open(filename, "w") as f:
+                f.write("\n".join(",".join(row) for row in rows) + "\n")
+            store = MessageStore(csv_to_store(filename))
+            expected = [FormattedMessage(row) for row in rows]
+            self.assertEqual(len(store), len(expected))
+            for msg, target in zip(store, expected):
+                self.assertEqual(repr(msg), repr(target))
+            self.assertEqual(store[3].new_ref, 2)
+            self.assertEqual(store[5].shares, 100)
+
+
+class TestArchive(unittest.TestCase):
+    def test_window(self):
+        days = [np.array([to_record(msg) for msg in generate_messages(5000, seed=seed)], dtype=MESSAGE_DTYPE)
+                for seed in range(2)]
+        with tempfile.TemporaryDirectory() as folder:
+            filename = write_archive(days, os.path.join(folder, "test.arc"), block_size=1000)
+            timestamps = days[1]["timestamp"]
+            start, end = timestamps[1500], timestamps[3200]
+            expected = days[1][(timestamps >= start) & (timestamps < end)]
+            for workers in [None, 2]:
+                with Archive(filename, workers) as archive:
+                    self.assertEqual(archive.days, 2)
+                    self.assertEqual(len(archive.find_blocks(1, start, end)), 3)
+                    self.assertTrue(np.array_equal(archive.window(day=0), days[0]))
+                    self.assertTrue(np.array_equal(archive.window(start, end, day=1), expected))
+                    source = archive.source(1, start, end)
+                    self.assertEqual(len(source), len(expected))
+                    self.assertEqual([to_record(msg) for msg in source], expected.tolist())
+            feed = Feed(filename)
+            self.assertEqual(feed.size, len(days[0]))
+            self.assertFalse(feed.messages.archive.f.closed)
+            count = 0
+            while feed.has_next():
+                feed.next()
+                count += 1
+            self.assertEqual(count, len(days[0]))
+            self.assertTrue(feed.messages.archive.f.closed)  # the feed opened the archive, the source closes it
+
+
+class TestWriters(unittest.TestCase):
+    def test_pool(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filenames = [os.path.join(folder, "%d.csv" % i) for i in range(10)]
+            expected = {filename: b"" for filename in filenames}
+            with BufferedWriters(FilePool(max_open=3), buffer_size=16, background=True) as writers:
+                for i in range(1000):
+                    filename = filenames[(i * 7) % len(filenames)]
+                    writers.write(filename, b"%d\n" % i)
+                    expected[filename] += b"%d\n" % i
+                self.assertLessEqual(len(writers.pool.files), 3)
+            for filename in filenames:
+                with open(filename, "rb") as f:
+                    self.assertEqual(f.read(), expected[filename])
+
+    def test_max_buffered(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filenames = [os.path.join(folder, "%d.csv" % i) for i in range(50)]
+            expected = {filename: b"" for filename in filenames}
+            with BufferedWriters(FilePool(max_open=3), buffer_size=1 << 16, max_buffered=1000) as writers:
+                for i in range(5000):
+                    filename = filenames[(i * 7) % len(filenames)]
+                    writers.write(filename, b"%d\n" % i)
+                    expected[filename] += b"%d\n" % i
+                    self.assertLessEqual(writers.buffered, 1000)
+                    self.assertEqual(writers.buffered, sum(len(buffer) for buffer in writers.buffers.values()))
+                writers.truncate(filenames[0])
+                expected[filenames[0]] = b""
+                self.assertEqual(writers.buffered, sum(len(buffer) for buffer in writers.buffers.values()))
+            for filename in filenames:
+                with open(filename, "rb") as f:
+                    self.assertEqual(f.read(), expected[filename])
+
+    def test_parse(self):
+        messages = generate_messages(5000, seed=0)
+        with tempfile.TemporaryDirectory() as folder:
+            write_itch(messages, os.path.join(folder, "S020117-v50.txt.gz"))
+            parse.parse_and_save(os.path.join(folder, "S020117-v50.txt.gz"), folder, buffer_size=256)
+            with open(os.path.join(folder, "AAPL-20170102.csv"), "r") as f:
+                rows = list(csv.reader(f))
+        real = [msg for msg in messages if msg.ref > 0 and msg.type[0] != 'M']
+        self.assertEqual(len(rows), len(real))  # the last buffered rows are written too
+        self.assertEqual([row[0] + row[2] for row in rows], [msg.type[0] + str(msg.ref) for msg in real])
+
+
+class TestPipeline(unittest.TestCase):
+    def test_replay(self):
+        messages = [msg for msg in generate_messages(5000, algo_share=0, seed=0) if msg.type[0] != 'M']
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, "S020117-v50.txt.gz")
+            write_itch(messages, filename)
+            with ItchPipeline(filename, batch_size=100, queue_size=2) as pipeline:
+                self.assertEqual([repr(msg) for msg in pipeline], [repr(msg) for msg in messages])
+            order_book, expected = OrderBook(), OrderBook()
+            with ItchPipeline(filename, batch_size=100) as pipeline:
+                self.assertEqual(pipeline.replay(order_book, until=messages[3000].timestamp), 3000)
+        for msg in messages[:3000]:
+            expected.process_message(msg)
+        self.assertEqual(dict(order_book.ask_book.volumes), dict(expected.ask_book.volumes))
+        self.assertEqual(dict(order_book.bid_book.volumes), dict(expected.bid_book.volumes))
+
+    def test_dropped_iterator(self):
+        messages = [msg for msg in generate_messages(5000, algo_share=0, seed=0) if msg.type[0] != 'M']
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, "S020117-v50.txt.gz")
+            write_itch(messages, filename)
+            pipeline = ItchPipeline(filename, batch_size=100, queue_size=1)
+            feed = Feed(pipeline)
+            for _ in range(10):
+                feed.next()
+            del feed  # never replayed to the end nor closed, the queues are full
+            for thread in pipeline.threads:
+                thread.join(timeout=5)
+                self.assertFalse(thread.is_alive())
+
+
+class TestServer(unittest.TestCase):
+    def test_replay(self):
+        messages = generate_messages(5000, seed=0)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "replay.sock")
+            server = ReplayServer(np.array([to_record(msg) for msg in messages], dtype=MESSAGE_DTYPE), path,
+                                  subscribers=2, batch_size=100, max_pending=2)
+            thread = threading.Thread(target=asyncio.run, args=(server.run(),))
+            thread.start()
+            results = []
+            reader = threading.Thread(target=lambda: results.append([repr(msg) for msg in ReplayClient(path)]))
+            reader.start()
+            received = [repr(msg) for msg in Feed.load("unix:" + path)]
+            reader.join()
+            thread.join()
+        self.assertEqual(received, [repr(msg) for msg in messages])
+        self.assertEqual(results, [received])
+        self.assertEqual((server.sent, server.dropped), ((len(messages) + 99) // 100, 0))
+        self.assertFalse(os.path.exists(path))
+
+    def run_server(self, data, subscribers, **kwargs):
+        """
+        serve data to the subscribers, callables of the socket path run in threads, returns (server, their results)
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "replay.sock")
+            server = ReplayServer(data, path, subscribers=len(subscribers), **kwargs)
+            thread = threading.Thread(target=asyncio.run, args=(server.run(),))
+            thread.start()
+            results = [None] * len(subscribers)
+
+            def read(i, subscriber):
+                results[i] = subscriber(path)
+
+            readers = [threading.Thread(target=read, args=(i, subscriber)) for i, subscriber in enumerate(subscribers)]
+            for reader in readers:
+                reader.start()
+            for reader in readers + [thread]:
+                reader.join()
+        return server, results
+
+    @staticmethod
+    def records(n, gap=1):
+        data = np.zeros(n, dtype=MESSAGE_DTYPE)
+        data["type"], data["timestamp"] = b"DA", gap * np.arange(n)
+        return data
+
+    def test_drop(self):
+        # the slow subscriber is disconnected, the replay goes on at the pace of the fast one and still ends
+        def slow(path):
+            try:
+                for _ in ReplayClient(path).batches():
+                    time.sleep(0.2)
+            except ConnectionError:
+                return "dropped"
+
+        def fast(path):
+            return sum(len(block) for block in ReplayClient(path).batches())
+
+        data = self.records(100000)
+        server, results = self.run_server(data, [slow, fast], batch_size=1000, max_pending=2, slow="drop")
+        self.assertEqual(results, ["dropped", len(data)])
+        self.assertEqual((server.sent, server.dropped), (100, 1))
+
+    def test_speed(self):
+        # 200ms of messages at twice the real time
+        def timed(path):
+            start = time.perf_counter()
+            count = sum(len(block) for block in ReplayClient(path).batches())
+            return count, time.perf_counter() - start
+
+        data = self.records(200, gap=1000000)
+        server, [(count, elapsed)] = self.run_server(data, [timed], speed=2, batch_size=20)
+        self.assertEqual(count, len(data))
+        self.assertGreaterEqual(elapsed, 0.09)  # the last batch is due 90ms after the first
+
+
+class TestStats(unittest.TestCase):
+    def test_sketch(self):
+        values = np.random.default_rng(0).exponential(19500, 20000)
+        whole, first, second = QuantileSketch(0.01), QuantileSketch(0.01), QuantileSketch(0.01)
+        whole.add_many(values)
+        first.add_many(values[:5000])
+        second.add_many(values[5000:])
+        first.merge(second)
+        for q in [0.01, 0.5, 0.9, 0.99]:
+            self.assertAlmostEqual(first.quantile(q), whole.quantile(q))
+            self.assertLessEqual(abs(whole.quantile(q) / np.quantile(values, q) - 1), 0.02)
+
+    def test_merge(self):
+        messages = generate_messages(5000, seed=0)
+        whole, first, second = MarketStats(bucket_ns=int(1E7)), MarketStats(bucket_ns=int(1E7)), \
+            MarketStats(bucket_ns=int(1E7), buffer_size=7)
+        for i, msg in enumerate(messages):
+            whole.observe(msg)
+            (first if i < 2000 else second).observe(msg)
+        first.merge(second)
+        total, expected = first.total(), whole.total()
+        self.assertEqual(total.counts, expected.counts)
+        self.assertEqual(sum(total.counts.values()), len(messages))
+        self.assertEqual(total.gaps.count, expected.gaps.count - 1)  # the gap between the halves is not seen
+        self.assertEqual(len(first.buckets), len(whole.buckets))
+
+    def test_max_gap(self):
+        messages = generate_messages(5000, seed=0)
+        stats = MarketStats(max_gap=80000)
+        for msg in messages:
+            stats.observe(msg)
+        fit = ExponentialLatency.fit([msg.timestamp for msg in messages], cutoff=80000)
+        gaps = stats.total().gaps
+        self.assertLess(gaps.max, 80000)
+        self.assertAlmostEqual(gaps.mean(), fit.scale)
+
+
+class TestFeed(unittest.TestCase):
+    def test_merge(self):
+        make = lambda ref, timestamp: FormattedMessage(["DA", str(ref), str(timestamp), "", "", ""])
+        feed = Feed([make(1, 10), make(2, 20), make(3, 30)])
+        feed.add_source([make(4, 15), make(5, 20)])
+        feed.add_source([make(6, 5)], offset=100)
+        feed.push(make(-1, 25))
+        feed.push(make(-2, 12))  # algo messages can arrive out of order
+        feed.push(make(-3, 20))
+        refs = []
+        while feed.has_next():
+            refs.append(feed.next().ref)
+        self.assertEqual(refs, [1, -2, 4, 2, 5, -3, -1, 3, 6])
+        self.assertEqual(feed.size, 6)
+        self.assertEqual(feed.wall_time, 105)
+
+    def test_unsized_source(self):
+        # a generator has no length, the replay still ends with it while algo messages are in flight
+        make = lambda ref, timestamp: FormattedMessage(["AA", str(ref), str(timestamp), "", "1000", "100"])
+        feed = Feed(make(ref, 10 * ref) for ref in range(1, 6))
+        feed.push(make(-1, 100))
+        refs = []
+        while feed.has_next():
+            refs.append(feed.next().ref)
+        self.assertEqual(refs, [1, 2, 3, 4, 5])
+        self.assertEqual(feed.size, 0)
+
+        def messages():
+            for i in range(5):  # the book before the open
+                yield FormattedMessage(["AA", str(i + 1), str(34199999900 + i), "", str(1010000 + 100 * i), "300"])
+                yield FormattedMessage(["AB", str(i + 11), str(34199999900 + i), "", str(1000000 - 100 * i), "300"])
+            for i in range(300):
+                yield FormattedMessage(["AA" if i % 2 else "AB", str(100 + i), str(34200000000 + 1000 * i), "",
+                                        "1020000" if i % 2 else "990000", "100"])
+        sim = Simulator(RandomAgent(1, 1, seed=0), messages(), default_config)
+        sim.run_simulation()  # no progress in % without a size
+        self.assertGreaterEqual(sim.counter, 310)
+
+
+class TestSmartOrderRouter(unittest.TestCase):
+    def setUp(self):
+        self.order_book = OrderBook()
+        for i in range(5):
+            self.order_book.process_message(FormattedMessage(["AA", i + 1, 0, 0, 10100 + 100 * i, 100]))
+            self.order_book.process_message(FormattedMessage(["AB", i + 11, 0, 0, 9900 - 100 * i, 100]))
+        self.feed = Feed([])
+        self.env = types.SimpleNamespace(position=0)
+        self.sor = SmartOrderRouter(self.feed, self.order_book, self.env, target_size=100, alpha=0.5, skip_size=50)
+
+    def sent(self):
+        # algo messages in submission order, they are also applied to the book
+        messages = [entry[-1] for entry in sorted(self.feed.heap)]
+        self.feed.heap = []
+        for msg in messages:
+            self.order_book.process_message(msg)
+        return messages
+
+    def test_pop_outside(self):
+        profile = Profile(ask=True)
+        for ref, price in [(1, 9900), (2, 10000), (3, 10050), (4, 10100), (5, 10200)]:
+            profile.add(ExecutionInfo(ref, price, 10))
+        self.assertEqual(sorted(info.ref for info in profile.pop_outside(10000, 10100)), [1, 5])
+        self.assertEqual(sorted(profile.orders), [2, 3, 4])
+        self.assertEqual(list(profile.levels), [10000, 10050, 10100])
+        self.assertEqual(profile.pop_outside(10000, 10100), [])
+
+    def test_refill(self):
+        self.sor.execute(0)
+        messages = self.sent()
+        self.assertEqual([(msg.type, msg.price, msg.shares) for msg in messages], [("AA2", 10100, 100),
+                                                                                   ("AB2", 9900, 100)])
+        self.sor.execute(0)
+        self.assertEqual(self.sent(), [])
+        # a partial fill is topped up with a new order at the same price
+        self.assertEqual(self.sor.update_submission("S", [ExecutionInfo(messages[0].ref, 10100, 40)]), 40)
+        self.sor.execute(0)
+        self.assertEqual([(msg.type, msg.price, msg.shares) for msg in self.sent()], [("AA2", 10100, 40)])
+        self.assertEqual(self.sor.ask_profile.submitted, 100)
+        # moving away re-prices one stale order and deletes the others in one batch
+        stale = sorted(self.sor.ask_profile.orders)
+        self.sor.execute(2)
+        messages = self.sent()
+        self.assertEqual([msg.type for msg in messages], ["UA2", "DA", "UB2"])
+        replace, delete = messages[0], messages[1]
+        self.assertEqual(sorted([replace.ref, delete.ref]), stale)
+        self.assertEqual((replace.price, replace.shares), (10300, 100))
+        self.assertEqual(list(self.sor.ask_profile.orders), [replace.new_ref])
+        self.assertEqual(set(self.order_book.ask_book.pool) & set(stale), set())
+        self.assertEqual(self.order_book.ask_book.volumes[10100], 100)
+        self.assertEqual(self.order_book.ask_book.volumes[10300], 200)
+
+    def test_batched_delete(self):
+        for shares in [40, 30, 30]:
+            ref = self.feed.add_order(10100, shares, ask=True)
+            self.sor.ask_profile.add(ExecutionInfo(ref, 10100, shares))
+        self.sent()
+        self.sor.ask_profile.submitted = 100
+        self.sor.execute(0)
+        self.assertEqual([msg.type for msg in self.sent()], ["AB2"])
+        self.sor.execute(2)
+        messages = [msg for msg in self.sent() if msg.type[1] == "A"]
+        self.assertEqual([msg.type for msg in messages], ["UA2", "DA", "DA"])
+        self.assertEqual(len({msg.timestamp for msg in messages}), 1)
+        self.assertEqual(self.order_book.ask_book.volumes[10100], 100)
+        self.assertEqual(self.sor.ask_profile.submitted, 100)
+
+    def test_empty_delete(self):
+        feeds = [Feed([], latency=UniformLatency(1500, 3000, rng=0)) for _ in range(2)]
+        feeds[0].wall_time = 100
+        feeds[0].delete_orders([], ask=True)
+        self.assertEqual(len(feeds[0].heap), 0)
+        for feed in feeds:
+            feed.wall_time = 200
+        self.assertEqual(feeds[0].time(), feeds[1].time())  # the seeded latency stream did not move
+
+    def test_liquidation(self):
+        self.sor.execute(0)
+        self.sent()
+        self.env.position = 200
+        self.sor.execute(9)
+        messages = self.sent()
+        self.assertEqual([(msg.type, msg.shares if msg.type[0] == "M" else None) for msg in messages],
+                         [("DB", None), ("MS", 100)])
+        self.assertEqual((len(self.sor.bid_profile.orders), self.sor.bid_profile.submitted), (0, 0))
+        self.assertEqual(len(self.sor.ask_profile.orders), 1)
+        self.env.position = -50
+        self.sor.execute(9)
+        self.assertEqual([(msg.type, msg.shares if msg.type[0] == "M" else None) for msg in self.sent()],
+                         [("DA", None), ("MB", 25)])
+
+    def test_replace_message(self):
+        order_book = OrderBook()
+        for row in [["AA", 1, 0, 0, 10100, 100], ["AA2", -1, 0, 0, 10100, 50], ["AA", 2, 0, 0, 10100, 70],
+                    ["AA", 3, 0, 0, 10200, 100], ["AB", 11, 0, 0, 9900, 100]]:
+            order_book.process_message(FormattedMessage(row))
+        msg = FormattedMessage()
+        msg.type, msg.ref, msg.new_ref, msg.timestamp, msg.price, msg.shares = "UA2", -1, -2, 1, 10200, 60
+        order_book.process_message(msg)
+        book = order_book.ask_book
+        self.assertNotIn(-1, book)
+        self.assertEqual((book.pool[-2].price, book.pool[-2].shares, book.pool[-2].real), (10200, 60, False))
+        self.assertEqual(dict(book.volumes), {10100: 170, 10200: 160})
+        # a replace loses its priority, the orders around it keep their queue positions
+        queue = lambda price: [order.ref for order in book.level_pool[price] if order.valid]
+        self.assertEqual(queue(10100), [1, 2])
+        self.assertEqual(queue(10200), [3, -2])
+        self.assertEqual(book.get_front_real_order().ref, 1)
+        self.assertEqual(check_invariants(order_book), [])
+
+
+class TestVectorSimulator(unittest.TestCase):
+    def run_envs(self, filename, workers):
+        actions = np.array([[i % 9, (i * 5) % 10] for i in range(100000)])
+        steps = []
+        with VectorSimulator([filename, filename], default_config, offsets=[0, 700], workers=workers) as envs:
+            steps.append((envs.states, np.zeros(2), envs.dones))
+            while not envs.dones.all():
+                steps.append(envs.step(actions[len(steps)]))
+        return steps
+
+    def test_parity(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, "SYN-20170102-v2.csv")
+            write_csv(generate_messages(1500, seed=0, algo_share=0), filename)
+            filename = csv_to_store(filename)
+            local, remote = self.run_envs(filename, False), self.run_envs(filename, True)
+        self.assertEqual(len(local), len(remote))
+        for (states, rewards, dones), (expected_states, expected_rewards, expected_dones) in zip(remote, local):
+            np.testing.assert_array_equal(states, expected_states)
+            np.testing.assert_array_equal(rewards, expected_rewards)
+            np.testing.assert_array_equal(dones, expected_dones)
+        # the env with the offset finishes first, then keeps its last states and gets no reward
+        finished = next(i for i, (_, _, dones) in enumerate(local) if dones[1])
+        self.assertFalse(local[finished][2][0])
+        for states, rewards, dones in local[finished + 1:]:
+            np.testing.assert_array_equal(states[1], local[finished][0][1])
+            self.assertEqual(rewards[1], 0)
+            self.assertTrue(dones[1])
+
+    def test_worker_failure(self):
+        with self.assertRaises(RuntimeError) as context:
+            VectorSimulator(["missing-v2.csv"], default_config, workers=True)
+        self.assertIn("FileNotFoundError", str(context.exception))
+
+
+class TestLatency(unittest.TestCase):
+    def test_sampling(self):
+        delays = [UniformLatency(1500, 3000, rng=0).draw() for _ in range(1000)]
+        self.assertTrue(all(1500 <= delay < 3000 for delay in delays))
+        latency, same_seed = ExponentialLatency(20000, offset=100, rng=1), ExponentialLatency(20000, offset=100, rng=1)
+        delays = [latency.draw() for _ in range(5000)]
+        self.assertEqual(delays, [same_seed.draw() for _ in range(5000)])
+        self.assertGreaterEqual(min(delays), 100)
+        self.assertTrue(set(EmpiricalLatency([1, 2, 3], rng=2).draw_block(100).tolist()) <= {1, 2, 3})
+
+    def test_fit(self):
+        gaps = np.random.default_rng(0).exponential(20000, 200000)
+        timestamps = np.cumsum(gaps)
+        self.assertAlmostEqual(ExponentialLatency.fit(timestamps, cutoff=np.inf).scale / 20000, 1, delta=0.01)
+        # gaps of 80000 and more are ignored, as in research.py
+        deltas = np.diff(timestamps)
+        self.assertAlmostEqual(ExponentialLatency.fit(timestamps).scale, deltas[deltas < 80000].mean())
+        self.assertEqual(len(EmpiricalLatency.fit(timestamps).samples), np.count_nonzero(deltas < 80000))
+
+    def test_block_draws(self):
+        # pre-drawn blocks give the same sequence as one draw per call
+        for latency in [lambda size: UniformLatency(1500, 3000, rng=3, block_size=size),
+                        lambda size: ExponentialLatency(20000, rng=3, block_size=size),
+                        lambda size: EmpiricalLatency([1, 2, 3, 5, 8], rng=3, block_size=size)]:
+            blocked, single = latency(7), latency(1)
+            self.assertEqual([blocked.draw() for _ in range(50)], [single.draw() for _ in range(50)])
+        blocked, single = RandomAgent(1, 9, seed=0, block_size=7), RandomAgent(1, 9, seed=0, block_size=1)
+        blocked.action_space = single.action_space = list(range(9))
+        self.assertEqual([blocked.act(None) for _ in range(50)], [single.act(None) for _ in range(50)])
+
+
+class TestLedger(unittest.TestCase):
+    def test_average_cost(self):
+        ledger = Ledger(capacity=2)
+        ledger.fill(1, -1, BUY, 100, 100)
+        ledger.fill(2, -2, BUY, 110, 100)
+        self.assertEqual(ledger.avg_cost, 105)
+        ledger.fill(3, -3, SELL, 120, 50)
+        self.assertEqual(ledger.realized, 750)
+        self.assertEqual(ledger.unrealized(100), -750)
+        ledger.fill(4, -4, SELL, 90, 250)  # flip to short
+        self.assertEqual(ledger.position, -100)
+        self.assertEqual(ledger.avg_cost, 90)
+        self.assertEqual(ledger.realized, 750 - 150 * 15)
+        ledger.fill(5, -5, BUY, 80, 100)
+        self.assertEqual(ledger.position, 0)
+        # when flat, the realized pnl is the cash flow of all fills
+        fills = ledger.get_fills()
+        self.assertEqual(ledger.realized, -np.sum(fills["side"] * fills["price"] * fills["shares"]))
+        self.assertEqual(list(fills["timestamp"]), [1, 2, 3, 4, 5])
+        self.assertEqual(ledger.counts, {BUY: 3, SELL: 2})
+
+    def test_empty_fill(self):
+        ledger = Ledger()
+        for side in [BUY, SELL]:
+            with self.assertRaises(ValueError):
+                ledger.fill(1, -1, side, 100, 0)
+        self.assertEqual((ledger.size, ledger.position, ledger.avg_cost), (0, 0, 0))
+
+
+class TestReplayBuffer(unittest.TestCase):
+    def test_ring_and_mmap(self):
+        with tempfile.TemporaryDirectory() as folder:
+            buffer = ReplayBuffer(4, 2, path=folder, seed=0)
+            for i in range(6):
+                buffer.append([i, -i], i, float(i), [i + 1, -i - 1], i == 5)
+            buffer.flush()
+            reader = ReplayBuffer.open(folder, seed=0)
+            self.assertEqual(len(reader), 4)
+            self.assertEqual(sorted(reader.actions), [2, 3, 4, 5])  # oldest transitions are overwritten
+            indices, (states, actions, rewards, next_states, dones) = reader.sample(100)
+            np.testing.assert_array_equal(states[:, 0], actions)
+            np.testing.assert_array_equal(dones, actions == 5)
+            buffer.update_priorities(np.array([0]), np.array([1e6]))
+            indices, _, weights = buffer.sample_prioritized(100)
+            self.assertGreater(np.mean(indices == 0), 0.9)
+
+    def test_empty(self):
+        buffer = ReplayBuffer(4, 2, seed=0)
+        with self.assertRaisesRegex(ValueError, "empty"):
+            buffer.sample(10)
+        with self.assertRaisesRegex(ValueError, "empty"):
+            buffer.sample_prioritized(10)
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        rows = [["AA", ref, ref, "", 1000 + ref, 100] for ref in range(1, 6)]
+        rows += [["AB", ref, ref, "", 900 - ref, 100] for ref in range(6, 9)] + [["DA", 1, 10, "", "", ""]]
+        self.messages = [FormattedMessage([str(value) for value in row]) for row in rows]
+
+    def test_book(self):
+        order_book = OrderBook()
+        with Profiler().attach(order_book) as profiler:
+            for msg in self.messages:
+                order_book.process_message(msg)
+        self.assertNotIn("process_message", vars(order_book))
+        stats = profiler.report()["stats"]
+        self.assertEqual({name: hist["count"] for name, hist in stats.items()},
+                         {"book.AA": 5, "book.AB": 3, "book.DA": 1})
+        profiler.detach()  # twice is fine
+
+    def test_stacked(self):
+        order_book = OrderBook()
+        process = order_book.process_message = lambda msg: None
+        outer, inner = Profiler().attach(order_book), Profiler().attach(order_book)
+        with self.assertRaises(RuntimeError):
+            outer.detach()  # still wrapped by inner
+        order_book.process_message(self.messages[0])
+        inner.detach()
+        order_book.process_message(self.messages[1])
+        outer.detach()
+        self.assertIs(order_book.process_message, process)
+        self.assertEqual(inner.stats["book.AA"].count, 1)
+        self.assertEqual(outer.stats["book.AA"].count, 2)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
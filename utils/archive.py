@@ -0,0 +1,221 @@
+"""
+Block-compressed message archive for many days of tagged messages. Messages are stored in blocks of a fixed number of
+messages, column by column, compressed with zlib or lzma. A footer index holds the file offset, first / last timestamp,
+message offset and day of every block, so a time window only decompresses the blocks it overlaps.
+
+    file: MAGIC, codec, blocks..., index (INDEX_DTYPE), index offset (i8), number of blocks (i8), MAGIC
+"""
+import lzma
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utils.store import MESSAGE_DTYPE, load_store, read_records, to_message
+
+MAGIC = b"MSGARC01"
+CODECS = {"zlib": (1, lambda data, level: zlib.compress(data, 6 if level is None else level), zlib.decompress),
+          "lzma": (2, lambda data, level: lzma.compress(data, preset=6 if level is None else level), lzma.decompress),
+          "none": (0, lambda data, level: data, lambda data: data)}
+INDEX_DTYPE = np.dtype([("offset", "i8"), ("length", "i8"), ("first", "i8"), ("last", "i8"), ("start", "i8"),
+                        ("count", "i8"), ("day", "i8")])
+
+
+def encode_block(block: np.ndarray):
+    # column by column, each column compresses far better than interleaved records
+    return b"".join(np.ascontiguousarray(block[name]).tobytes() for name in MESSAGE_DTYPE.names)
+
+
+def decode_block(data, count):
+    block = np.empty(count, dtype=MESSAGE_DTYPE)
+    offset = 0
+    for name in MESSAGE_DTYPE.names:
+        dtype = MESSAGE_DTYPE.fields[name][0]
+        block[name] = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += dtype.itemsize * count
+    return block
+
+
+class ArchiveWriter:
+    def __init__(self, filename, codec="zlib", block_size=65536, level=None):
+        if codec not in CODECS:
+            raise ValueError("Unknown codec: %s" % codec)
+        self.codec = codec
+        self.compress = CODECS[codec][1]
+        self.level = level
+        self.block_size = block_size
+        self.f = open(filename, "wb")
+        self.f.write(MAGIC + bytes([CODECS[codec][0]]))
+        self.index = []
+        self.days = 0
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_day(self, messages):
+        """
+        messages is a message array, a .npy message store or a tagged message csv. Blocks never span two days.
+        Returns the day number
+        """
+        if isinstance(messages, str):
+            messages = load_store(messages) if messages.endswith(".npy") else read_records(messages)
+        for start in range(0, len(messages), self.block_size):
+            block = np.asarray(messages[start: start + self.block_size])
+            data = self.compress(encode_block(block), self.level)
+            self.index.append((self.f.tell(), len(data), block["timestamp"][0], block["timestamp"][-1], self.count,
+                               len(block), self.days))
+            self.f.write(data)
+            self.count += len(block)
+        self.days += 1
+        return self.days - 1
+
+    def close(self):
+        if self.f.closed:
+            return
+        offset = self.f.tell()
+        self.f.write(np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+        self.f.write(np.array([offset, len(self.index)], dtype=np.int64).tobytes() + MAGIC)
+        self.f.close()
+
+
+def write_archive(sources, outfile, codec="zlib", block_size=65536, level=None):
+    """
+    one day per source, see ArchiveWriter.add_day
+    """
+    with ArchiveWriter(outfile, codec, block_size, level) as writer:
+        for source in sources:
+            writer.add_day(source)
+    return outfile
+
+
+class Archive:
+    def __init__(self, filename, workers=None):
+        """
+        workers > 1 decompresses blocks on a thread pool, zlib and lzma release the GIL
+        """
+        self.filename = filename
+        self.f = open(filename, "rb")
+        header = self.f.read(len(MAGIC) + 1)
+        if header[:len(MAGIC)] != MAGIC:
+            raise RuntimeError("Not a message archive: %s" % filename)
+        codecs = {code: decompress for code, _, decompress in CODECS.values()}
+        self.decompress = codecs[header[-1]]
+        self.f.seek(-16 - len(MAGIC), 2)
+        trailer = self.f.read()
+        if trailer[16:] != MAGIC:
+            raise RuntimeError("Archive footer missing, the writer was not closed: %s" % filename)
+        offset, num_blocks = np.frombuffer(trailer[:16], dtype=np.int64).tolist()
+        self.f.seek(offset)
+        self.index = np.frombuffer(self.f.read(num_blocks * INDEX_DTYPE.itemsize), dtype=INDEX_DTYPE)
+        self.days = int(self.index["day"][-1]) + 1 if num_blocks > 0 else 0
+        self.executor = ThreadPoolExecutor(workers) if workers is not None and workers > 1 else None
+        self.workers = workers or 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return int(self.index["count"].sum())
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.f.close()
+
+    def read_raw(self, i):
+        self.f.seek(int(self.index["offset"][i]))
+        return self.f.read(int(self.index["length"][i]))
+
+    def decode(self, i, data):
+        return decode_block(self.decompress(data), int(self.index["count"][i]))
+
+    def read_block(self, i):
+        return self.decode(i, self.read_raw(i))
+
+    def find_blocks(self, day=0, start=None, end=None):
+        """
+        indices of the blocks of one day that overlap [start, end)
+        """
+        blocks = np.flatnonzero(self.index["day"] == day)
+        if start is not None:
+            blocks = blocks[self.index["last"][blocks] >= start]
+        if end is not None:
+            blocks = blocks[self.index["first"][blocks] < end]
+        return blocks
+
+    def iter_blocks(self, blocks):
+        """
+        decoded blocks in order. With a thread pool, reading stays sequential and up to 2 * workers blocks are
+        decompressed ahead
+        """
+        if self.executor is None:
+            for i in blocks:
+                yield self.read_block(i)
+            return
+        pending = deque()
+        for i in blocks:
+            pending.append(self.executor.submit(self.decode, i, self.read_raw(i)))
+            if len(pending) >= 2 * self.workers:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+    def window(self, start=None, end=None, day=0):
+        """
+        message array of [start, end) on one day
+        """
+        blocks = self.find_blocks(day, start, end)
+        if len(blocks) == 0:
+            return np.empty(0, dtype=MESSAGE_DTYPE)
+        data = np.concatenate(list(self.iter_blocks(blocks)))
+        return _trim(data, start, end)
+
+    def source(self, day=0, start=None, end=None, owned=False):
+        """
+        messages of [start, end) on one day for Feed.add_source, decompressed block by block as the feed advances.
+        An owned source closes the archive once it is exhausted or its iterator is dropped
+        """
+        return ArchiveSource(self, day, start, end, owned)
+
+
+def _trim(block, start, end):
+    # timestamps are sorted within a day
+    lo = 0 if start is None else np.searchsorted(block["timestamp"], start, side="left")
+    hi = len(block) if end is None else np.searchsorted(block["timestamp"], end, side="left")
+    return block[lo: hi]
+
+
+class ArchiveSource:
+    def __init__(self, archive: Archive, day=0, start=None, end=None, owned=False):
+        self.archive = archive
+        self.owned = owned
+        self.start = start
+        self.end = end
+        self.blocks = archive.find_blocks(day, start, end)
+        self.size = None
+
+    def __len__(self):
+        if self.size is None:
+            counts = self.archive.index["count"][self.blocks]
+            self.size = int(counts.sum())
+            if len(self.blocks) > 0 and (self.start is not None or self.end is not None):
+                # only the boundary blocks are partly outside the window
+                for i in {self.blocks[0], self.blocks[-1]}:
+                    self.size += len(_trim(self.archive.read_block(i), self.start, self.end))
+                    self.size -= int(self.archive.index["count"][i])
+        return self.size
+
+    def __iter__(self):
+        try:
+            for block in self.archive.iter_blocks(self.blocks):
+                for row in _trim(block, self.start, self.end).tolist():
+                    yield to_message(*row)
+        finally:
+            if self.owned:
+                self.archive.close()
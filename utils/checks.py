@@ -1,6 +1,16 @@
+"""
+Order book validation. validate() replays many symbol-days on a process pool and checks the book invariants while
+replaying: the book is never crossed (every message) and, every sample_every messages, no volume is negative, the
+volume of every level equals the shares of its live orders and the pool holds exactly the live orders.
 
+    python -m utils.checks data/*-v2.csv --workers 8 --every 1000
+"""
+import argparse
 import csv
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+from market.components import Feed
 from market.order_book import OrderBook, FormattedMessage
 import numpy as np
 
@@ -11,14 +21,14 @@ def check_book(filename):
         reader = csv.reader(f)
         prev_timestamp = 0
         order_book = OrderBook()
-        start = time.clock()
+        start = time.perf_counter()
         counter = 0
         for row in reader:
             counter += 1
             order_book.process_message(FormattedMessage(row))
             if counter % 1000 == 0:
-                print("\rElapsed: %ds / %d" % (time.clock() - start, counter), end='', flush=True)
-    print("\rTotal: %ds / %d\n" % (time.clock() - start, counter), end='', flush=True)
+                print("\rElapsed: %ds / %d" % (time.perf_counter() - start, counter), end='', flush=True)
+    print("\rTotal: %ds / %d\n" % (time.perf_counter() - start, counter), end='', flush=True)
     print("%d %d" % (len(order_book.ask_book.pool), len(order_book.bid_book.pool)))
 
     count = 0
@@ -28,4 +38,117 @@ def check_book(filename):
         for order in level:
             count += order.valid
     print("\n%d" % count)
-    print("ask volume level: ", len(book.volumes))
\ No newline at end of file
+    print("ask volume level: ", len(book.volumes))
+
+
+def is_crossed(order_book):
+    ask_book, bid_book = order_book.ask_book, order_book.bid_book
+    return len(ask_book.levels) > 0 and len(bid_book.levels) > 0 and bid_book.levels[0] >= ask_book.levels[0]
+
+
+def check_invariants(order_book):
+    """
+    violations of the book invariants that are more expensive than the crossing check
+    """
+    errors = []
+    for side, book in [("ask", order_book.ask_book), ("bid", order_book.bid_book)]:
+        live = 0
+        for price, level in book.level_pool.items():
+            shares = 0
+            for order in level:
+                if order.valid:
+                    shares += order.shares
+                    live += 1
+                    if book.pool.get(order.ref) is not order:
+                        errors.append("%s order %d is live but not in the pool" % (side, order.ref))
+            if shares != book.volumes.get(price, 0):
+                errors.append("%s volume at %d is %d, live orders have %d" % (side, price, book.volumes.get(price, 0),
+                                                                                shares))
+        for price, volume in book.volumes.items():
+            if volume < 0:
+                errors.append("%s volume at %d is negative (%d)" % (side, price, volume))
+            elif volume > 0 and price not in book.level_pool:
+                errors.append("%s volume at %d is %d without a level" % (side, price, volume))
+        if live != len(book.pool):
+            errors.append("%s pool has %d orders, levels have %d live" % (side, len(book.pool), live))
+        if len(book.levels) != len(book.level_pool):
+            errors.append("%s has %d sorted levels and %d level queues" % (side, len(book.levels),
+                                                                            len(book.level_pool)))
+    return errors
+
+
+def validate_file(filename, sample_every=1000, max_errors=20):
+    """
+    replay one message file (any format Feed.load reads) and check the invariants. Returns a result dict with the
+    throughput, the number of mismatches and the first max_errors of them
+    """
+    result = {"filename": filename, "messages": 0, "seconds": 0., "throughput": 0., "checks": 0, "mismatches": 0,
+              "errors": [], "exception": ""}
+    order_book = OrderBook()
+
+    def report(counter, errors):
+        result["mismatches"] += len(errors)
+        for error in errors[:max_errors - len(result["errors"])]:
+            result["errors"].append("message %d: %s" % (counter, error))
+
+    start = perf_counter()
+    counter = 0
+    try:
+        for msg in Feed.load(filename):
+            order_book.process_message(msg)
+            counter += 1
+            if is_crossed(order_book):
+                report(counter, ["crossed book, bid %d / ask %d" % (order_book.get_bid(), order_book.get_ask())])
+            if sample_every and counter % sample_every == 0:
+                result["checks"] += 1
+                report(counter, check_invariants(order_book))
+        result["checks"] += 1
+        report(counter, check_invariants(order_book))  # end of day
+    except Exception as e:
+        result["exception"] = "message %d: %r" % (counter, e)
+    result["messages"] = counter
+    result["seconds"] = perf_counter() - start
+    result["throughput"] = counter / result["seconds"] if result["seconds"] > 0 else 0.
+    result.update(ask_orders=len(order_book.ask_book.pool), bid_orders=len(order_book.bid_book.pool),
+                  ask_volume_levels=len(order_book.ask_book.volumes), bid_volume_levels=len(order_book.bid_book.volumes))
+    return result
+
+
+def _validate(args):
+    return validate_file(*args)
+
+
+def validate(filenames, workers=None, sample_every=1000, max_errors=20):
+    """
+    validate every file on a process pool, results are printed as they finish and returned in input order
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_validate, (filename, sample_every, max_errors)): filename for filename in filenames}
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            status = "ok" if result["mismatches"] == 0 and result["exception"] == "" else "FAILED"
+            print("%s: %s, %d messages, %.0f msgs/s, %d mismatches %s" % (
+                status, result["filename"], result["messages"], result["throughput"], result["mismatches"],
+                result["exception"]))
+            for error in result["errors"]:
+                print("    " + error)
+    return [results[filename] for filename in filenames]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay message files and check the order book invariants")
+    parser.add_argument("filenames", nargs="+", help="tagged message csv, .npy message stores or .arc archives")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--every", type=int, default=1000, help="full invariant check every n messages, 0 for end "
+                                                                  "of day only")
+    parser.add_argument("--max-errors", type=int, default=20, help="errors kept per file")
+    args = parser.parse_args()
+
+    results = validate(args.filenames, args.workers, args.every, args.max_errors)
+    failed = [result for result in results if result["mismatches"] > 0 or result["exception"] != ""]
+    total = sum(result["messages"] for result in results)
+    print("Validated %d files / %d messages, %d failed" % (len(results), total, len(failed)))
+    if len(failed) > 0:
+        raise SystemExit(1)
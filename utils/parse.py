@@ -6,6 +6,7 @@ import time
 
 from utils.MessageHandler import Tokenizer
 from utils.MessageHandler import parse_message
+from utils.writer import BufferedWriters, FilePool
 from utils import Message
 
 
@@ -28,7 +29,12 @@ def format_message(msg):
     return None
 
 
-def parse_and_save(src, out_path):
+def parse_and_save(src, out_path, max_open=256, buffer_size=1 << 16, background=True, max_buffered=1 << 28):
+    """
+    split a day of ITCH into one csv per symbol. At most max_open files are kept open and every file is written in
+    chunks of buffer_size bytes, by a background thread if background is True. At most max_buffered bytes are held
+    in memory over all symbols
+    """
     if not os.path.exists(src):
         raise RuntimeError("Source file not exists")
     if not os.path.exists(out_path):
@@ -36,18 +42,21 @@ def parse_and_save(src, out_path):
     date = datetime.strptime(str(os.path.basename(src).split("-")[0][1:]), "%d%m%y")
     date = datetime.strftime(date, "%Y%m%d")
 
-    get_name = lambda x: os.path.join(out_path, "%s-%s.csv" % (x.decode().strip(), date))
+    names = {}  # stock -> csv filename
+
+    def get_name(x):
+        if x not in names:
+            names[x] = os.path.join(out_path, "%s-%s.csv" % (x.decode().strip(), date))
+        return names[x]
 
-    to_save = {}
     record = {}
     counter = 0
-    reset = 0
-    start = time.clock()
-    with Tokenizer(src) as reader:
+    start = time.perf_counter()
+    with Tokenizer(src) as reader, BufferedWriters(FilePool(max_open), buffer_size, background,
+                                                   max_buffered=max_buffered) as writers:
         while True:
             msg = parse_message(reader.get_message())
             counter += 1
-            reset += 1
             # if counter > 1E5:
             #     break
 
@@ -55,8 +64,7 @@ def parse_and_save(src, out_path):
                 break
 
             if isinstance(msg, Message.StockDirectory):
-                with open(get_name(msg.stock), "w") as f:
-                    pass
+                writers.truncate(get_name(msg.stock))
             else:
                 if isinstance(msg, Message.OrderAdd) or isinstance(msg, Message.OrderAddMpid):
                     record[msg.ref] = msg.stock
@@ -71,17 +79,8 @@ def parse_and_save(src, out_path):
                     stock = record[msg.ref]
                 else:
                     stock = msg.stock
-                if stock in to_save:
-                    to_save[stock].append(",".join([str(x) for x in tmp]))
-                else:
-                    to_save[stock] = [",".join([str(x) for x in tmp])]
+                writers.write(get_name(stock), (",".join([str(x) for x in tmp]) + "\n").encode())
 
-            if reset >= 2E5:
-                delta = time.clock() - start
+            if counter % 200000 == 0:
+                delta = time.perf_counter() - start
                 print("\r%d (elapsed: %dmin / rate: %d)" % (counter, delta / 60, counter / delta), end="", flush=True)
-                for k, v in to_save.items():
-                    with open(get_name(k), "a") as f:
-                        f.write("\n".join(v) + "\n")
-                to_save.clear()
-                reset = 0
-
@@ -0,0 +1,202 @@
+"""
+Streaming replay straight from a raw ITCH gzip, without the intermediate csv files. Three stages are connected by
+bounded queues of batches:
+
+    reader thread: gzip + Tokenizer -> raw messages
+    decoder thread: raw messages of one stock -> tagged FormattedMessage (side of E / X / D / U from the add)
+    consumer: iterate, use as a Feed source, or replay into an OrderBook
+
+Decompression releases the GIL, so it overlaps with decoding and book maintenance
+"""
+import queue
+import struct
+import threading
+from utils.MessageHandler import Tokenizer
+from utils.store import to_message
+
+_ADD = struct.Struct("!HH6sQcI8sI")  # A, F has the MPID appended
+_EXECUTE = struct.Struct("!HH6sQIQ")  # E, C has the price appended
+_CANCEL = struct.Struct("!HH6sQI")
+_DELETE = struct.Struct("!HH6sQ")
+_REPLACE = struct.Struct("!HH6sQQII")
+_STOP = None  # end of stream marker
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class Decoder:
+    """
+    tags the messages of one stock like parse2.preprocess_data, the stock locate is taken from the stock directory
+    unless given
+    """
+    def __init__(self, stock="AAPL", locate=None):
+        self.stock = stock.encode().ljust(8)
+        self.locate = locate
+        self.sides = {}  # ref -> 'A' / 'B'
+        self.finished = False
+
+    def decode(self, raws):
+        output = []
+        sides = self.sides
+        for msg in raws:
+            kind = msg[0]
+            if kind == 82:  # R, stock directory
+                if self.locate is None and msg[11:19] == self.stock:
+                    self.locate = (msg[1] << 8) | msg[2]
+                continue
+            if kind == 83 and msg[11:12] == b'C':  # S, end of system hours
+                self.finished = True
+                break
+            if self.locate is None or (msg[1] << 8) | msg[2] != self.locate:
+                continue
+            if kind == 65 or kind == 70:  # A / F
+                _, _, timestamp, ref, buy_sell, shares, _, price = _ADD.unpack_from(msg, 1)
+                side = 'B' if buy_sell == b'B' else 'A'
+                sides[ref] = side
+                output.append(to_message('A' + side, ref, int.from_bytes(timestamp, "big"), 0, price, shares))
+            elif kind == 69 or kind == 67:  # E / C
+                _, _, timestamp, ref, shares, _ = _EXECUTE.unpack_from(msg, 1)
+                output.append(to_message('E' + sides[ref], ref, int.from_bytes(timestamp, "big"), 0, 0, shares))
+            elif kind == 88:  # X
+                _, _, timestamp, ref, shares = _CANCEL.unpack_from(msg, 1)
+                output.append(to_message('X' + sides[ref], ref, int.from_bytes(timestamp, "big"), 0, 0, shares))
+            elif kind == 68:  # D
+                _, _, timestamp, ref = _DELETE.unpack_from(msg, 1)
+                output.append(to_message('D' + sides.pop(ref), ref, int.from_bytes(timestamp, "big"), 0, 0, 0))
+            elif kind == 85:  # U
+                _, _, timestamp, ref, new_ref, shares, price = _REPLACE.unpack_from(msg, 1)
+                side = sides.pop(ref)
+                sides[new_ref] = side
+                output.append(to_message('U' + side, ref, int.from_bytes(timestamp, "big"), new_ref, price, shares))
+        return output
+
+
+class ItchPipeline:
+    def __init__(self, filename, stock="AAPL", locate=None, batch_size=1024, queue_size=16):
+        self.filename = filename
+        self.decoder = Decoder(stock, locate)
+        self.batch_size = batch_size
+        self.raw_queue = queue.Queue(queue_size)
+        self.queue = queue.Queue(queue_size)
+        self.stop = threading.Event()
+        self.threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        if len(self.threads) == 0:
+            self.threads = [threading.Thread(target=self._read, daemon=True),
+                            threading.Thread(target=self._decode, daemon=True)]
+            for thread in self.threads:
+                thread.start()
+        return self
+
+    def _put(self, q, item):
+        # give up when the consumer has stopped, a full queue would block forever
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _STOP
+
+    def _read(self):
+        try:
+            with Tokenizer(self.filename) as reader:
+                batch = []
+                while True:
+                    msg = reader.get_message()
+                    if len(msg) == 0:
+                        break
+                    batch.append(msg)
+                    if len(batch) >= self.batch_size:
+                        if not self._put(self.raw_queue, batch):
+                            return
+                        batch = []
+                        if self.decoder.finished:
+                            break
+                if len(batch) > 0:
+                    self._put(self.raw_queue, batch)
+        except Exception as e:
+            self._put(self.raw_queue, _Failure(e))
+        self._put(self.raw_queue, _STOP)
+
+    def _decode(self):
+        while True:
+            batch = self._get(self.raw_queue)
+            if batch is _STOP or isinstance(batch, _Failure):
+                self._put(self.queue, batch)
+                return
+            try:
+                messages = self.decoder.decode(batch)
+            except Exception as e:
+                self._put(self.queue, _Failure(e))
+                return
+            if len(messages) > 0 and not self._put(self.queue, messages):
+                return
+            if self.decoder.finished:
+                self._put(self.queue, _STOP)
+                return
+
+    def batches(self):
+        """
+        lists of tagged messages in file order
+        """
+        self.start()
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is _STOP or isinstance(batch, _Failure):
+                    if isinstance(batch, _Failure):
+                        raise batch.error
+                    return
+                yield batch
+        finally:
+            # also when the consumer drops the iterator early, e.g. a Feed that is not replayed to the end,
+            # the threads give up their next put instead of waiting on a full queue forever
+            self.stop.set()
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def replay(self, order_book, until=None):
+        """
+        process every message (with timestamp < until) into order_book, returns the number of messages
+        """
+        counter = 0
+        process = order_book.process_message
+        for batch in self.batches():
+            if until is not None and batch[-1].timestamp >= until:
+                for msg in batch:
+                    if msg.timestamp >= until:
+                        self.close()
+                        return counter
+                    process(msg)
+                    counter += 1
+            else:
+                for msg in batch:
+                    process(msg)
+                counter += len(batch)
+        return counter
+
+    def close(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,223 @@
+"""
+Optional profiling of the replay path. Profiler.attach wraps methods of one OrderBook / Simulator instance, so nothing
+changes for instances that are not attached and detach restores them. MemoryMonitor attaches the same way and samples
+the structure sizes instead of timing calls
+"""
+import json
+import tracemalloc
+from time import perf_counter, perf_counter_ns
+
+_MISSING = object()
+
+
+def _patch(patched, obj, attr, wrapper):
+    # the instance attribute it replaces, e.g. the wrapper of another monitor, is put back by _restore
+    patched.append((obj, attr, wrapper, obj.__dict__.get(attr, _MISSING)))
+    setattr(obj, attr, wrapper)
+
+
+def _restore(patched):
+    """
+    undo the patches in reverse order, safe to call twice. A wrapper that was wrapped again by a profiler or monitor
+    still attached cannot be taken out of the chain: RuntimeError, the remaining patches stay for a later detach
+    """
+    while len(patched) > 0:
+        obj, attr, wrapper, previous = patched[-1]
+        if obj.__dict__.get(attr) is not wrapper:
+            raise RuntimeError("%s.%s was wrapped again since, detach in the reverse order of attach"
+                               % (type(obj).__name__, attr))
+        if previous is _MISSING:
+            delattr(obj, attr)  # the class method shows through again
+        else:
+            setattr(obj, attr, previous)
+        patched.pop()
+
+
+class Histogram:
+    """
+    latency histogram with power of 2 buckets in ns
+    """
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ns):
+        self.buckets[ns.bit_length()] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def to_dict(self):
+        return {"count": self.count, "total_ns": self.total, "mean_ns": self.total / self.count if self.count else 0,
+                "max_ns": self.max, "per_sec": self.count / self.total * 1E9 if self.total else 0,
+                "buckets": {"<%d" % (1 << i): n for i, n in enumerate(self.buckets) if n > 0}}
+
+
+class Profiler:
+    def __init__(self):
+        self.stats = {}
+        self.patched = []
+        self.start = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.detach()
+
+    def record(self, name, ns):
+        if name not in self.stats:
+            self.stats[name] = Histogram()
+        self.stats[name].add(ns)
+
+    def wrap(self, obj, attr, name, key=None):
+        """
+        time obj.attr under name, key(*args) gives a suffix of the name, e.g. the message type
+        """
+        original = getattr(obj, attr)
+        record = self.record
+
+        if key is None:
+            def timed(*args, **kwargs):
+                start = perf_counter_ns()
+                result = original(*args, **kwargs)
+                record(name, perf_counter_ns() - start)
+                return result
+        else:
+            def timed(*args, **kwargs):
+                start = perf_counter_ns()
+                result = original(*args, **kwargs)
+                record(name + "." + key(*args), perf_counter_ns() - start)
+                return result
+
+        _patch(self.patched, obj, attr, timed)
+
+    def attach(self, target):
+        """
+        target is an OrderBook or a Simulator
+        """
+        self.start = perf_counter()
+        if hasattr(target, "order_book"):
+            self.wrap(target, "step", "step")
+            self.wrap(target.SOR, "execute", "step.execute")
+            self.wrap(target.SOR, "update_submission", "step.netting")
+            self.wrap(target.ledger, "record", "step.ledger")
+            self.wrap(target, "update_states", "step.states")
+            self.wrap(target.feed, "next", "feed.next")
+            self.wrap(target.feed, "push", "feed.push")
+            target = target.order_book
+        self.wrap(target, "process_message", "book", key=lambda msg: msg.type)
+        return self
+
+    def detach(self):
+        _restore(self.patched)
+
+    def report(self):
+        elapsed = perf_counter() - self.start if self.start is not None else 0
+        return {"elapsed_s": elapsed, "stats": {name: hist.to_dict() for name, hist in sorted(self.stats.items())}}
+
+    def dump(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class MemoryMonitor:
+    def __init__(self, every=10000, trace=False, limits=None, keep=True):
+        """
+        sample the sizes (target.sizes()) every `every` processed messages and keep their high-water marks. trace
+        follows the Python heap with tracemalloc, which slows the replay down a lot. limits maps a size name to its
+        maximum, a sample above it raises RuntimeError. keep stores every sample, not only the last one
+        """
+        self.every = every
+        self.trace = trace
+        self.limits = {} if limits is None else limits
+        self.keep = keep
+        self.samples = []
+        self.last = {}
+        self.high = {}  # name -> (value, messages processed when it was reached)
+        self.counter = 0
+        self.target = None
+        self.patched = []
+        self.tracing = False  # tracemalloc was started by this monitor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.detach()
+
+    def attach(self, target):
+        """
+        target is an OrderBook or a Simulator, every message processed into its book is counted
+        """
+        self.target = target
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        order_book = target.order_book if hasattr(target, "order_book") else target
+        original = order_book.process_message
+        every = self.every
+
+        def sampled(msg):
+            try:
+                result = original(msg)
+            except Exception:
+                self.sample(check=False)  # the sizes that led to the failure, e.g. too many volume levels
+                raise
+            self.counter += 1
+            if self.counter % every == 0:
+                self.sample()
+            return result
+
+        _patch(self.patched, order_book, "process_message", sampled)
+        return self
+
+    def detach(self):
+        _restore(self.patched)
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def sample(self, check=True):
+        """
+        sizes now, also callable on demand
+        """
+        sizes = {"messages": self.counter}
+        sizes.update(self.target.sizes())
+        if tracemalloc.is_tracing():
+            sizes["traced_bytes"], sizes["traced_peak_bytes"] = tracemalloc.get_traced_memory()
+        for name, value in sizes.items():
+            if name != "messages" and (name not in self.high or value > self.high[name][0]):
+                self.high[name] = (value, self.counter)
+        self.last = sizes
+        if self.keep:
+            self.samples.append(sizes)
+        if check:
+            exceeded = ["%s %d > %d" % (name, sizes[name], limit) for name, limit in self.limits.items()
+                        if sizes.get(name, 0) > limit]
+            if len(exceeded) > 0:
+                raise RuntimeError("Size limit exceeded after %d messages: %s" % (self.counter, ", ".join(exceeded)))
+        return sizes
+
+    def allocations(self, top=10):
+        """
+        the lines holding the most traced memory
+        """
+        if not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        return [{"line": str(stat.traceback), "bytes": stat.size, "blocks": stat.count}
+                for stat in snapshot.statistics("lineno")[:top]]
+
+    def report(self, top=10):
+        return {"messages": self.counter, "samples": len(self.samples), "last": self.last,
+                "high_water": {name: {"value": value, "messages": messages}
+                               for name, (value, messages) in sorted(self.high.items())},
+                "allocations": self.allocations(top)}
+
+    def dump(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
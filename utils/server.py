@@ -0,0 +1,193 @@
+"""
+Replay one day of messages to many local subscribers. The server reads the message store once and publishes batches
+of raw message records over a Unix socket, paced by the message timestamps if speed is given. Each subscriber has a
+bounded queue: with slow="block" the slowest subscriber throttles the replay, with slow="drop" a subscriber whose
+queue is full is disconnected. As fast as possible replays go at the pace of the fastest subscriber and only drop one
+that fell a whole queue behind it, socket buffers let a slow subscriber look fast for the first frames.
+ReplayClient reads the stream and can be used as a Feed source ("unix:" + path).
+
+    python -m utils.server data/AAPL-20170102-v2.npy /tmp/aapl.sock --subscribers 3 --speed 10
+"""
+import argparse
+import asyncio
+import os
+import socket
+import struct
+import time
+import numpy as np
+from utils.store import MESSAGE_DTYPE, load_store, read_records, to_message
+
+HEADER = struct.Struct("!II")  # payload bytes, number of messages. 0 messages ends the stream
+_CLOSE = None  # queue marker, disconnect without the end of stream frame
+
+
+class ReplayServer:
+    def __init__(self, source, path, subscribers=1, speed=None, batch_size=1024, max_pending=64, slow="block"):
+        """
+        source is a message array, a .npy message store or a tagged csv. The replay starts once subscribers are
+        connected. speed is the replay speed relative to real time, None for as fast as possible
+        """
+        if slow not in ["block", "drop"]:
+            raise ValueError("Unknown slow subscriber policy: %s" % slow)
+        if isinstance(source, str):
+            source = load_store(source) if source.endswith(".npy") else read_records(source)
+        self.data = source
+        self.path = path
+        self.subscribers = subscribers
+        self.speed = speed
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.slow = slow
+        self.queues = {}  # subscriber queue -> stream writer
+        self.delivered = {}  # subscriber queue -> frames written to its socket
+        self.handlers = set()
+        self.ready = None
+        self.progress = None  # set whenever a subscriber got a frame or left
+        self.sent = 0  # batches published
+        self.dropped = 0  # subscribers disconnected for being slow
+
+    async def _handle(self, reader, writer):
+        queue = asyncio.Queue(self.max_pending)
+        self.queues[queue] = writer
+        self.delivered[queue] = 0
+        self.handlers.add(asyncio.current_task())
+        if len(self.queues) >= self.subscribers:
+            self.ready.set()
+        try:
+            while True:
+                frame = await queue.get()
+                if frame is _CLOSE:
+                    break
+                writer.write(frame)
+                await writer.drain()  # waits while the subscriber's socket buffer is full
+                self.delivered[queue] += 1
+                self.progress.set()
+                if len(frame) == HEADER.size:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.queues.pop(queue, None)
+            self.delivered.pop(queue, None)
+            self.progress.set()
+            while not queue.empty():  # release a publisher waiting on this queue
+                queue.get_nowait()
+            writer.close()
+            try:
+                await writer.wait_closed()  # buffered frames are flushed before the loop ends
+            except ConnectionError:
+                pass
+
+    def _behind(self, queue):
+        # paced replays drop whoever cannot keep up, otherwise only a subscriber a whole queue behind the fastest one
+        return self.speed is not None or max(self.delivered.values()) - self.delivered[queue] >= self.max_pending
+
+    async def _publish(self, frame):
+        for queue in list(self.queues):
+            # a full queue waits for its subscriber until it falls behind, the publisher then follows the fastest
+            while self.slow == "drop" and queue in self.queues and queue.full() and not self._behind(queue):
+                self.progress.clear()
+                await self.progress.wait()
+            if queue not in self.queues:
+                continue
+            if self.slow == "drop" and queue.full():
+                self.queues.pop(queue).transport.abort()  # also wakes the handler if it waits in drain
+                self.dropped += 1
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(_CLOSE)
+            else:
+                await queue.put(frame)
+
+    async def run(self):
+        self.ready = asyncio.Event()
+        self.progress = asyncio.Event()
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        try:
+            async with server:
+                await self.ready.wait()
+                loop = asyncio.get_running_loop()
+                start_time, first_timestamp = loop.time(), None
+                for start in range(0, len(self.data), self.batch_size):
+                    block = np.ascontiguousarray(self.data[start: start + self.batch_size])
+                    if self.speed is not None:
+                        if first_timestamp is None:
+                            first_timestamp = int(block["timestamp"][0])
+                        delay = start_time + (int(block["timestamp"][0]) - first_timestamp) / 1E9 / self.speed \
+                            - loop.time()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    await self._publish(HEADER.pack(block.nbytes, len(block)) + block.tobytes())
+                    self.sent += 1
+                    await asyncio.sleep(0)  # a put into a free queue does not yield, let the writers run
+                await self._publish(HEADER.pack(0, 0))
+                await asyncio.gather(*self.handlers)  # until every subscriber got the end of the stream
+        finally:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def serve(source, path, subscribers=1, speed=None, batch_size=1024, max_pending=64, slow="block"):
+    server = ReplayServer(source, path, subscribers, speed, batch_size, max_pending, slow)
+    asyncio.run(server.run())
+    return server
+
+
+class ReplayClient:
+    """
+    one subscription, iterating connects and yields the messages until the end of the stream
+    """
+    def __init__(self, path, connect_timeout=10.):
+        self.path = path
+        self.connect_timeout = connect_timeout
+
+    def _connect(self):
+        # the server may still be starting
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+
+    def batches(self):
+        """
+        message arrays as published
+        """
+        sock = self._connect()
+        with sock, sock.makefile("rb") as f:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    raise ConnectionError("Replay stream closed before its end, the subscriber was too slow")
+                nbytes, count = HEADER.unpack(header)
+                if count == 0:
+                    return
+                payload = f.read(nbytes)
+                if len(payload) < nbytes:
+                    raise ConnectionError("Replay stream closed before its end, the subscriber was too slow")
+                yield np.frombuffer(payload, dtype=MESSAGE_DTYPE, count=count)
+
+    def __iter__(self):
+        for block in self.batches():
+            for row in block.tolist():
+                yield to_message(*row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a message store to local subscribers")
+    parser.add_argument("source", help=".npy message store or tagged message csv")
+    parser.add_argument("path", help="Unix socket path")
+    parser.add_argument("--subscribers", type=int, default=1, help="start once this many are connected")
+    parser.add_argument("--speed", type=float, default=None, help="1 for real time, as fast as possible if omitted")
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--slow", choices=["block", "drop"], default="block")
+    args = parser.parse_args()
+
+    result = serve(args.source, args.path, args.subscribers, args.speed, args.batch_size, slow=args.slow)
+    print("Replay: %d batches, %d subscribers dropped" % (result.sent, result.dropped))
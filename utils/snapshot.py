@@ -0,0 +1,132 @@
+"""
+Market-by-price snapshots on a fixed clock: the top depth levels of each side every interval ns between start and
+end, in preallocated columns (one .npy file per column if a folder is given, written through memory maps):
+
+    timestamp (n,), ask_price / ask_volume / bid_price / bid_volume (n, depth)
+
+The snapshot at time t is the book after every message with timestamp < t, missing levels are 0. The replay loop only
+compares each timestamp with a cursor, the book is read once per crossed interval and copied over quiet stretches.
+
+    python -m utils.snapshot data/AAPL-20170102-v2.npy snapshots/AAPL-20170102 --depth 10 --interval 100
+"""
+import argparse
+import os
+from time import perf_counter
+import numpy as np
+from numpy.lib.format import open_memmap
+from market.components import Feed
+from market.order_book import OrderBook
+
+COLUMNS = ["timestamp", "ask_price", "ask_volume", "bid_price", "bid_volume"]
+
+
+class SnapshotRecorder:
+    def __init__(self, order_book, depth=10, interval=int(1E8), start=int(342E11), end=int(576E11), folder=None):
+        """
+        snapshots of order_book at start, start + interval, ... before end (9:30 to 16:00 every 100ms by default)
+        """
+        self.order_book = order_book
+        self.depth = depth
+        self.interval = int(interval)
+        self.start = int(start)
+        self.size = max(0, -(-(int(end) - self.start) // self.interval))
+        self.folder = folder
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+        self.files = {name: self._allocate(name, (self.size,) if name == "timestamp" else (self.size, depth))
+                      for name in COLUMNS}
+        self.columns = {name: np.asarray(column) for name, column in self.files.items()}  # without memmap overhead
+        self.columns["timestamp"][:] = self.start + self.interval * np.arange(self.size, dtype=np.int64)
+        self.sides = [(order_book.ask_book, self.columns["ask_price"], self.columns["ask_volume"]),
+                      (order_book.bid_book, self.columns["bid_price"], self.columns["bid_volume"])]
+        self.padding = [0] * depth
+        self.row = 0  # next snapshot to take
+        self.next_time = self.start if self.size > 0 else np.inf
+
+    def _allocate(self, name, shape):
+        if self.folder is None:
+            return np.zeros(shape, dtype=np.int64)
+        return open_memmap(os.path.join(self.folder, name + ".npy"), mode="w+", dtype=np.int64, shape=shape)
+
+    def _snapshot(self, row):
+        depth = self.depth
+        for book, prices, volumes in self.sides:
+            # only the front of levels is pruned, emptied levels further back stay until they reach it
+            levels, sizes = [], []
+            for price in book.levels:
+                volume = book.volumes[price]
+                if volume == 0:
+                    continue
+                levels.append(price)
+                sizes.append(volume)
+                if len(levels) == depth:
+                    break
+            padding = self.padding[len(levels):]
+            prices[row] = levels + padding
+            volumes[row] = sizes + padding
+
+    def advance(self, timestamp):
+        """
+        take the snapshots due before a message at timestamp is processed, returns the new cursor. The caller only
+        needs to call it once timestamp >= next_time
+        """
+        last = min((int(timestamp) - self.start) // self.interval, self.size - 1)
+        if last >= self.row:
+            self._fill(self.row, last + 1)
+        return self.next_time
+
+    def _fill(self, first, stop):
+        # the book does not change between the snapshots of one call
+        self._snapshot(first)
+        for name in COLUMNS[1:]:
+            column = self.columns[name]
+            column[first + 1: stop] = column[first]
+        self.row = stop
+        self.next_time = self.start + self.row * self.interval if self.row < self.size else np.inf
+
+    def close(self):
+        """
+        the book stays as it is after the last message, the remaining snapshots repeat it. Returns the columns
+        """
+        if self.row < self.size:
+            self._fill(self.row, self.size)
+        if self.folder is not None:
+            for column in self.files.values():
+                column.flush()
+        return self.columns
+
+
+def record(filename, folder=None, depth=10, interval=int(1E8), start=int(342E11), end=int(576E11)):
+    """
+    replay one message file (any format Feed.load reads) and record its snapshots, returns the columns
+    """
+    order_book = OrderBook()
+    recorder = SnapshotRecorder(order_book, depth, interval, start, end, folder)
+    process = order_book.process_message
+    next_time = recorder.next_time
+    for msg in Feed.load(filename):
+        if msg.timestamp >= next_time:
+            next_time = recorder.advance(msg.timestamp)
+            if recorder.row >= recorder.size:
+                break  # later messages are not in any snapshot
+        process(msg)
+    return recorder.close()
+
+
+def load_snapshots(folder, mmap_mode="r"):
+    return {name: np.load(os.path.join(folder, name + ".npy"), mmap_mode=mmap_mode) for name in COLUMNS}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record fixed interval order book snapshots of a message file")
+    parser.add_argument("filename", help="tagged message csv, .npy message store or .arc archive")
+    parser.add_argument("folder", help="one .npy file per column is written here")
+    parser.add_argument("--depth", type=int, default=10, help="levels per side")
+    parser.add_argument("--interval", type=float, default=100, help="ms between snapshots")
+    parser.add_argument("--start", type=float, default=342E11, help="ns since midnight")
+    parser.add_argument("--end", type=float, default=576E11, help="ns since midnight")
+    args = parser.parse_args()
+
+    begin = perf_counter()
+    columns = record(args.filename, args.folder, args.depth, int(args.interval * 1E6), int(args.start), int(args.end))
+    print("Snapshots: %d x %d levels in %.1fs" % (len(columns["timestamp"]), args.depth, perf_counter() - begin))
@@ -0,0 +1,245 @@
+"""
+Single pass market statistics with fixed memory per time bucket: message counts per type, inter-arrival histograms,
+approximate quantiles of inter-arrival times, spread and quote depth, and the cancel-to-trade ratio. Every statistic
+is mergeable, so a universe is collected with one process per symbol-day and merged afterwards
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from market.components import Feed
+from market.order_book import OrderBook
+
+
+class QuantileSketch:
+    """
+    DDSketch-like quantile sketch: values fall into logarithmic buckets, so every quantile is within
+    relative_accuracy of an exact one and two sketches merge by adding bucket counts. Values <= 0 are counted as 0
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.counts = {}  # bucket index -> count
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add_many(self, values):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        positive = values[values > 0]
+        self.zeros += len(values) - len(positive)
+        keys, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0.
+        seen = self.zeros
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen > rank:
+                # the bucket (gamma^(k-1), gamma^k] is represented by the value with the same relative error to both
+                return min(max(2 * self.gamma ** key / (self.gamma + 1), self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else np.nan
+
+    def to_dict(self, quantiles=(0.01, 0.1, 0.5, 0.9, 0.99)):
+        result = {"count": self.count, "mean": self.mean()}
+        if self.count > 0:
+            result.update(min=self.min, max=self.max)
+        result.update({"p%g" % (100 * q): self.quantile(q) for q in quantiles})
+        return result
+
+
+def log2_histogram(values):
+    """
+    counts of values in [2^(i-1), 2^i) at index i, index 0 is for values < 1
+    """
+    values = np.asarray(values, dtype=float)
+    bins = np.where(values >= 1, np.floor(np.log2(np.maximum(values, 1))) + 1, 0).astype(np.int64)
+    return np.bincount(np.minimum(bins, 63), minlength=64)
+
+
+class BucketStats:
+    def __init__(self, relative_accuracy=0.01):
+        self.counts = {}  # message type -> count
+        self.histogram = np.zeros(64, dtype=np.int64)  # inter-arrival times in ns
+        self.gaps = QuantileSketch(relative_accuracy)
+        self.spreads = QuantileSketch(relative_accuracy)
+        self.depths = QuantileSketch(relative_accuracy)
+
+    def merge(self, other):
+        for type_, count in other.counts.items():
+            self.counts[type_] = self.counts.get(type_, 0) + count
+        self.histogram += other.histogram
+        self.gaps.merge(other.gaps)
+        self.spreads.merge(other.spreads)
+        self.depths.merge(other.depths)
+        return self
+
+    def cancel_to_trade(self):
+        cancels = sum(count for type_, count in self.counts.items() if type_[0] in "XD")
+        trades = sum(count for type_, count in self.counts.items() if type_[0] in "EM")
+        return cancels / trades if trades > 0 else np.nan
+
+    def to_dict(self):
+        return {"messages": sum(self.counts.values()), "counts": dict(sorted(self.counts.items())),
+                "cancel_to_trade": self.cancel_to_trade(), "inter_arrival": self.gaps.to_dict(),
+                "inter_arrival_log2_histogram": {"<%d" % (1 << i): int(n) for i, n in enumerate(self.histogram)
+                                                 if n > 0},
+                "spread": self.spreads.to_dict(), "depth": self.depths.to_dict()}
+
+
+class MarketStats:
+    def __init__(self, symbol="", bucket_ns=int(18E11), start=None, end=None, relative_accuracy=0.01,
+                 buffer_size=4096, max_gap=None):
+        """
+        statistics per bucket_ns (30 minutes by default) of the messages with start <= timestamp < end. Values are
+        buffered up to buffer_size before they go into the sketches. Inter-arrival times >= max_gap are left out of
+        the gap statistics, as ExponentialLatency.fit does with its cutoff
+        """
+        self.symbol = symbol
+        self.bucket_ns = bucket_ns
+        self.start = start
+        self.end = end
+        self.relative_accuracy = relative_accuracy
+        self.buffer_size = buffer_size
+        self.max_gap = max_gap
+        self.buckets = {}  # bucket number -> BucketStats
+        self.prev_timestamp = None
+        self.pending = {"gaps": ([], []), "spreads": ([], []), "depths": ([], [])}  # (bucket numbers, values)
+
+    def get_bucket(self, bucket):
+        if bucket not in self.buckets:
+            self.buckets[bucket] = BucketStats(self.relative_accuracy)
+        return self.buckets[bucket]
+
+    def observe(self, msg, order_book=None):
+        """
+        count one message, order_book is the book after the message for spread and depth
+        """
+        timestamp = msg.timestamp
+        if (self.start is not None and timestamp < self.start) or (self.end is not None and timestamp >= self.end):
+            return
+        bucket = int(timestamp // self.bucket_ns)
+        counts = self.get_bucket(bucket).counts
+        counts[msg.type] = counts.get(msg.type, 0) + 1
+        if self.prev_timestamp is not None and (self.max_gap is None or timestamp - self.prev_timestamp < self.max_gap):
+            self._buffer("gaps", bucket, timestamp - self.prev_timestamp)
+        self.prev_timestamp = timestamp
+        if order_book is not None and len(order_book.ask_book.levels) > 0 and len(order_book.bid_book.levels) > 0:
+            self._buffer("spreads", bucket, order_book.get_spread())
+            self._buffer("depths", bucket, order_book.ask_book.get_quote_volume() +
+                         order_book.bid_book.get_quote_volume())
+
+    def _buffer(self, name, bucket, value):
+        buckets, values = self.pending[name]
+        buckets.append(bucket)
+        values.append(value)
+        if len(values) >= self.buffer_size:
+            self._flush(name)
+
+    def _flush(self, name):
+        buckets, values = self.pending[name]
+        if len(values) == 0:
+            return
+        buckets, values = np.array(buckets), np.array(values, dtype=float)
+        for bucket in np.unique(buckets).tolist():
+            selected = values[buckets == bucket]
+            stats = self.get_bucket(bucket)
+            getattr(stats, name).add_many(selected)
+            if name == "gaps":
+                stats.histogram += log2_histogram(selected)
+        self.pending[name] = ([], [])
+
+    def flush(self):
+        for name in self.pending:
+            self._flush(name)
+
+    def merge(self, other):
+        """
+        add the buckets of other, e.g. another symbol or the same symbol collected in another process
+        """
+        self.flush()
+        other.flush()
+        if other.bucket_ns != self.bucket_ns:
+            raise ValueError("Cannot merge statistics with different buckets")
+        for bucket, stats in other.buckets.items():
+            self.get_bucket(bucket).merge(stats)
+        return self
+
+    def total(self):
+        self.flush()
+        total = BucketStats(self.relative_accuracy)
+        for stats in self.buckets.values():
+            total.merge(stats)
+        return total
+
+    def to_dict(self):
+        self.flush()
+        return {"symbol": self.symbol, "bucket_ns": self.bucket_ns, "total": self.total().to_dict(),
+                "buckets": {bucket * self.bucket_ns: self.buckets[bucket].to_dict() for bucket in sorted(self.buckets)}}
+
+
+def collect(filename, symbol=None, with_book=True, **kwargs):
+    """
+    statistics of one message file (any format Feed.load reads), the symbol defaults to the file name prefix.
+    with_book replays the messages into an OrderBook for spread and depth
+    """
+    if symbol is None:
+        symbol = os.path.basename(filename).split("-")[0]
+    stats = MarketStats(symbol, **kwargs)
+    order_book = OrderBook() if with_book else None
+    for msg in Feed.load(filename):
+        if order_book is not None:
+            order_book.process_message(msg)
+        stats.observe(msg, order_book)
+    stats.flush()
+    return stats
+
+
+def _collect(args):
+    filename, with_book, kwargs = args
+    return collect(filename, with_book=with_book, **kwargs)
+
+
+def collect_universe(filenames, workers=None, with_book=True, **kwargs):
+    """
+    one process per file, returns ({symbol: MarketStats}, MarketStats of the whole universe)
+    """
+    by_symbol = {}
+    universe = MarketStats("*", **kwargs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for stats in pool.map(_collect, [(filename, with_book, kwargs) for filename in filenames]):
+            if stats.symbol in by_symbol:
+                by_symbol[stats.symbol].merge(stats)  # several days of one symbol
+            else:
+                by_symbol[stats.symbol] = stats
+            universe.merge(stats)
+    return by_symbol, universe
@@ -0,0 +1,79 @@
+
+import csv
+import numpy as np
+from market.elements import FormattedMessage
+
+# columnar layout of the tagged ("-v2.csv") message format
+MESSAGE_DTYPE = np.dtype([("type", "S3"), ("ref", "i8"), ("timestamp", "i8"), ("new_ref", "i8"), ("price", "i8"),
+                          ("shares", "i8")])
+
+
+def to_record(msg: FormattedMessage):
+    return (msg.type.encode(), msg.ref, msg.timestamp, getattr(msg, "new_ref", 0), getattr(msg, "price", 0) or 0,
+            getattr(msg, "shares", 0))
+
+
+def to_message(type_, ref, timestamp, new_ref, price, shares):
+    """
+    inverse of to_record, only set the fields that FormattedMessage would have parsed for this type
+    """
+    msg = FormattedMessage()
+    msg.type = type_.decode() if isinstance(type_, bytes) else type_
+    msg.ref = ref
+    msg.timestamp = timestamp
+    if msg.type[0] == 'A':
+        msg.price = price
+        msg.shares = shares
+    elif msg.type[0] == 'E' or msg.type[0] == 'X' or msg.type[0] == 'M':
+        msg.shares = shares
+    elif msg.type[0] == 'U':
+        msg.new_ref = new_ref
+        msg.price = price
+        msg.shares = shares
+    return msg
+
+
+def csv_to_store(filename, outfile=None):
+    """
+    convert a tagged message csv into a .npy message store, which can later be memory-mapped by many processes
+    """
+    if outfile is None:
+        outfile = filename[:-4] + ".npy"
+    np.save(outfile, read_records(filename))
+    return outfile
+
+
+def read_records(filename):
+    """
+    message array of a tagged message csv
+    """
+    with open(filename, "r") as f:
+        records = [to_record(FormattedMessage(row)) for row in csv.reader(f)]
+    return np.array(records, dtype=MESSAGE_DTYPE)
+
+
+def load_store(filename, mmap=True):
+    return np.load(filename, mmap_mode="r" if mmap else None)
+
+
+class MessageStore:
+    """
+    Sequence view of a message array. Messages are only materialized when accessed, so a memory-mapped store is
+    shared between processes instead of being copied into python objects
+    """
+    def __init__(self, data, chunk_size=65536):
+        if isinstance(data, str):
+            data = load_store(data)
+        self.data = data
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return to_message(*self.data[idx].tolist())
+
+    def __iter__(self):
+        for start in range(0, len(self.data), self.chunk_size):
+            for row in self.data[start: start + self.chunk_size].tolist():
+                yield to_message(*row)
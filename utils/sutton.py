@@ -1,4 +1,5 @@
 
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import random
 
@@ -39,6 +40,44 @@ class TilingsValueFunction:
             tileIndex = (state - self.tilings[tilingIndex]) // self.tileWidth
             self.params[tilingIndex, tileIndex] += delta
 
+    def get_values(self, states):
+        tileIndices = (np.asarray(states)[:, :1] - self.tilings) // self.tileWidth
+        return np.cumsum(self.params[np.arange(len(self.tilings)), tileIndices], axis=1)[:, -1]
+
+    def update_values(self, states, deltas):
+        tileIndices = (np.asarray(states)[:, :1] - self.tilings) // self.tileWidth
+        deltas = np.asarray(deltas, dtype=float)[:, None] / self.numOfTilings
+        np.add.at(self.params, (np.arange(len(self.tilings)), tileIndices), np.broadcast_to(deltas, tileIndices.shape))
+
+
+def generate_episodes(end_state, n, seed=None, block_size=32):
+    """
+    n random walks from the middle state at once, each step moves randint(1, end_state / 10) to either side until
+    the walk is absorbed at 0 or end_state. Returns the visited (non-terminal) states and the return of their episode
+    """
+    rng = np.random.default_rng(seed)
+    max_step = int(end_state / 10)
+    positions = np.full(n, end_state // 2)
+    alive = np.arange(n)
+    states, returns = [], []
+    rewards = np.zeros(n)
+    while len(alive) > 0:
+        steps = rng.integers(1, max_step + 1, size=(len(alive), block_size)) * \
+            rng.choice([-1, 1], size=(len(alive), block_size))
+        paths = positions[alive, None] + np.cumsum(steps, axis=1)
+        absorbed = (paths <= 0) | (paths >= end_state)
+        ended = absorbed.any(axis=1)
+        first = np.where(ended, absorbed.argmax(axis=1), block_size - 1)
+        # the state before every step, up to the step into the boundary
+        before = np.concatenate([positions[alive, None], paths[:, :-1]], axis=1)
+        visited = np.arange(block_size) <= first[:, None]
+        states.append(before[visited])
+        returns.append(np.repeat(alive, visited.sum(axis=1)))  # episode ids for now
+        rewards[alive[ended]] = np.where(paths[ended, first[ended]] <= 0, -1, 1)
+        positions[alive] = paths[:, -1]
+        alive = alive[~ended]
+    return np.concatenate(states), rewards[np.concatenate(returns)]
+
 
 class MonteCarloTester:
     def __init__(self, funcs, end_state):
@@ -54,7 +93,7 @@ class MonteCarloTester:
             alpha = 1 / (i + 1)
             self.train_once(alpha)
             for idx, func in enumerate(self.funcs):
-                values = [func.get_value([state]) for state in range(1, self.end_state)]
+                values = func.get_values(np.arange(1, self.end_state)[:, None])
                 self.errs[idx][i] = np.sqrt(np.mean(np.power(self.ans - values, 2)))
 
     def train_once(self, alpha):
@@ -73,3 +112,36 @@ class MonteCarloTester:
         for state in history[:-1]:
             for func in self.funcs:
                 func.update_value([state], alpha * (reward - func.get_value([state])))
+
+    def train_batch(self, n=20, batch_size=1000, alpha=0.004, seed=None, workers=None):
+        """
+        every iteration generates batch_size episodes at once and updates every visited state by alpha times the gap
+        to its average return. Updates of states sharing a tile add up, hence the small alpha. With workers, episode
+        generation is spread over a process pool
+        """
+        seeds = np.random.SeedSequence(seed).spawn(n * (workers or 1))
+        pool = ProcessPoolExecutor(workers) if workers else None
+        states = np.arange(1, self.end_state)[:, None]
+        for i in range(len(self.funcs)):
+            self.errs.append(np.zeros(n))
+        try:
+            for i in range(n):
+                if pool is None:
+                    visited, returns = generate_episodes(self.end_state, batch_size, seeds[i])
+                else:
+                    sizes = [len(chunk) for chunk in np.array_split(np.arange(batch_size), workers)]
+                    parts = list(pool.map(generate_episodes, [self.end_state] * workers, sizes,
+                                          seeds[i * workers: (i + 1) * workers]))
+                    visited = np.concatenate([part[0] for part in parts])
+                    returns = np.concatenate([part[1] for part in parts])
+                counts = np.bincount(visited, minlength=self.end_state)
+                mean_returns = np.bincount(visited, returns, minlength=self.end_state)
+                seen = np.flatnonzero(counts)
+                mean_returns = mean_returns[seen] / counts[seen]
+                for idx, func in enumerate(self.funcs):
+                    func.update_values(seen[:, None], alpha * (mean_returns - func.get_values(seen[:, None])))
+                    values = func.get_values(states)
+                    self.errs[idx][i] = np.sqrt(np.mean(np.power(self.ans - values, 2)))
+        finally:
+            if pool is not None:
+                pool.shutdown()
@@ -0,0 +1,490 @@
+"""
+Synthetic tagged message streams for testing and benchmarking without proprietary data. SyntheticStream keeps its own
+model of the book with the same FIFO rules as market.book.Book, so every execute, cancel and delete refers to an
+order that is live at that point of the replay. OrderFlow instead reads a live OrderBook and can be used as a Feed
+source
+"""
+import csv
+import gzip
+import struct
+from collections import deque
+import numpy as np
+from market.elements import FormattedMessage
+
+
+def _message(type_, ref, timestamp, price=None, shares=None, new_ref=None):
+    msg = FormattedMessage()
+    msg.type = type_
+    msg.ref = ref
+    msg.timestamp = timestamp
+    if price is not None:
+        msg.price = price
+    if shares is not None:
+        msg.shares = shares
+    if new_ref is not None:
+        msg.new_ref = new_ref
+    return msg
+
+
+class Arrivals:
+    """
+    inter-arrival times in ns. "hawkes" is a self-exciting process with an exponential kernel: every event raises the
+    intensity, branching is the expected number of events it triggers and decay the kernel time constant in ns. The
+    long run mean gap is mean_gap for every kind
+    """
+    def __init__(self, kind="exponential", mean_gap=19500, branching=0.5, decay=50000, rng=None):
+        if kind not in ["exponential", "uniform", "constant", "hawkes"]:
+            raise ValueError("Unknown arrival: %s" % kind)
+        if kind == "hawkes" and not 0 <= branching < 1:
+            raise ValueError("Hawkes branching ratio must be in [0, 1)")
+        self.kind = kind
+        self.mean_gap = mean_gap
+        self.rng = rng if isinstance(rng, np.random.Generator) else np.random.default_rng(rng)
+        self.beta = 1 / decay
+        self.alpha = branching * self.beta
+        self.mu = (1 - branching) / mean_gap  # baseline intensity
+        self.excess = 0.  # intensity above the baseline right after the last event
+
+    def draw(self, n):
+        if self.kind == "exponential":
+            return self.rng.exponential(self.mean_gap, n).astype(np.int64) + 1
+        if self.kind == "uniform":
+            return self.rng.integers(1, 2 * self.mean_gap, n)
+        if self.kind == "constant":
+            return np.full(n, self.mean_gap, dtype=np.int64)
+        # exact simulation (Dassios & Zhao): the next event is the first of the baseline arrival and the kernel arrival
+        baseline = self.rng.exponential(1 / self.mu, n).tolist()
+        uniforms = self.rng.random(n).tolist()
+        gaps = []
+        excess, alpha, beta = self.excess, self.alpha, self.beta
+        for i in range(n):
+            gap = baseline[i]
+            if excess > 0:
+                d = 1 + beta * np.log(uniforms[i]) / excess
+                if d > 0:
+                    gap = min(gap, -np.log(d) / beta)
+            excess = excess * np.exp(-beta * gap) + alpha
+            gaps.append(gap)
+        self.excess = excess
+        return np.array(gaps).astype(np.int64) + 1
+
+
+class RefPool:
+    """
+    set of live refs with O(1) uniform choice
+    """
+    def __init__(self):
+        self.refs = []
+        self.positions = {}  # ref -> index in refs
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __contains__(self, ref):
+        return ref in self.positions
+
+    def add(self, ref):
+        self.positions[ref] = len(self.refs)
+        self.refs.append(ref)
+
+    def remove(self, ref):
+        idx = self.positions.pop(ref)
+        last = self.refs.pop()
+        if last != ref:
+            self.refs[idx] = last
+            self.positions[last] = idx
+
+    def choose(self, uniform):
+        return self.refs[int(uniform * len(self.refs))]
+
+
+class SyntheticStream:
+    def __init__(self, depth=10, cancel_ratio=0.4, execute_ratio=0.1, replace_ratio=0.02, algo_share=0.05,
+                 arrival="exponential", mean_gap=19500, mid=1000000, tick=100, start=342E11, seed=None, **kwargs):
+        """
+        ratios are the probabilities of each event type, the rest are adds. arrival is one of the Arrivals kinds
+        with mean mean_gap ns, kwargs go to Arrivals. algo_share of the adds are algo generated (AA2 / AB2)
+        """
+        self.depth = depth
+        self.cancel_ratio = cancel_ratio
+        self.execute_ratio = execute_ratio
+        self.replace_ratio = replace_ratio
+        self.algo_share = algo_share
+        self.mid = mid
+        self.tick = tick
+        self.timestamp = int(start)
+        self.rng = np.random.default_rng(seed)
+        self.arrivals = Arrivals(arrival, mean_gap, rng=self.rng, **kwargs)
+        self.next_ref = 1
+        self.next_algo_ref = -1
+        self.orders = {}  # ref -> [ask, price, shares, real]
+        self.refs = RefPool()
+        self.levels = {}  # price -> deque of refs, dead refs are skipped lazily as in Book
+
+    def _message(self, type_, ref, price=None, shares=None, new_ref=None):
+        return _message(type_, ref, self.timestamp, price, shares, new_ref)
+
+    def _track(self, ref, ask, price, shares, real):
+        self.orders[ref] = [ask, price, shares, real]
+        self.refs.add(ref)
+        if price not in self.levels:
+            self.levels[price] = deque()
+        self.levels[price].append(ref)
+
+    def _forget(self, ref):
+        del self.orders[ref]
+        self.refs.remove(ref)
+
+    def _front(self, ask):
+        """
+        foremost live order of one side
+        """
+        for k in range(1, self.depth + 1):
+            level = self.levels.get(self.mid + k * self.tick if ask else self.mid - k * self.tick)
+            if level is None:
+                continue
+            while len(level) > 0 and level[0] not in self.orders:
+                level.popleft()
+            if len(level) > 0:
+                return level[0]
+        return None
+
+    def _add(self, ask, level, shares, real):
+        price = self.mid + level * self.tick if ask else self.mid - level * self.tick
+        if real:
+            ref = self.next_ref
+            self.next_ref += 1
+        else:
+            ref = self.next_algo_ref
+            self.next_algo_ref -= 1
+        self._track(ref, ask, price, shares, real)
+        return self._message(('AA' if ask else 'AB') + ('' if real else '2'), ref, price, shares)
+
+    def initial_book(self, orders_per_level=3):
+        """
+        add messages that populate every level before the open
+        """
+        messages = []
+        self.timestamp -= 2 * self.depth * orders_per_level
+        for level in range(1, self.depth + 1):
+            for _ in range(orders_per_level):
+                for ask in [True, False]:
+                    self.timestamp += 1
+                    messages.append(self._add(ask, level, 100 * int(self.rng.integers(1, 6)), True))
+        return messages
+
+    def generate(self, n, block_size=65536):
+        """
+        generate n messages, random numbers are drawn in blocks
+        """
+        messages = []
+        thresholds = np.cumsum([self.cancel_ratio, self.execute_ratio, self.replace_ratio])
+        while len(messages) < n:
+            size = min(block_size, n - len(messages))
+            gaps = self.arrivals.draw(size).tolist()
+            events = np.searchsorted(thresholds, self.rng.random(size), side="right").tolist()
+            sides = (self.rng.random(size) < 0.5).tolist()
+            levels = np.minimum(self.rng.geometric(0.3, size), self.depth).tolist()
+            shares = (100 * self.rng.integers(1, 6, size)).tolist()
+            reals = (self.rng.random(size) >= self.algo_share).tolist()
+            uniforms = self.rng.random(size).tolist()
+            for i in range(size):
+                self.timestamp += gaps[i]
+                messages.append(self._event(events[i], sides[i], levels[i], shares[i], reals[i], uniforms[i]))
+        return messages
+
+    def _event(self, event, ask, level, shares, real, uniform):
+        if event == 0 and len(self.refs) > 4 * self.depth:  # cancel or delete
+            ref = self.refs.choose(uniform)
+            order = self.orders[ref]
+            side = 'A' if order[0] else 'B'
+            if order[2] > 100 and uniform < 0.5:
+                cancelled = 100 * (1 + int(uniform * 2 * (order[2] // 100 - 1)))
+                order[2] -= cancelled
+                return self._message('X' + side, ref, shares=cancelled)
+            self._forget(ref)
+            return self._message('D' + side, ref)
+        if event == 1:  # execute against the front of one side
+            ref = self._front(ask)
+            if ref is not None:
+                order = self.orders[ref]
+                executed = min(shares, order[2])
+                if order[2] == executed:
+                    self._forget(ref)
+                else:
+                    order[2] -= executed
+                if order[3]:
+                    return self._message('E' + ('A' if ask else 'B'), ref, shares=executed)
+                return self._message('MS' if ask else 'MB', self.next_ref, shares=executed)  # hit an algo order
+        if event == 2 and len(self.refs) > 4 * self.depth:  # replace a real order
+            ref = self.refs.choose(uniform)
+            order = self.orders[ref]
+            if order[3]:
+                self._forget(ref)
+                new_ref = self.next_ref
+                self.next_ref += 1
+                price = self.mid + level * self.tick if order[0] else self.mid - level * self.tick
+                self._track(new_ref, order[0], price, shares, True)
+                return self._message('U' + ('A' if order[0] else 'B'), ref, price, shares, new_ref)
+        return self._add(ask, level, shares, real)
+
+
+def generate_messages(n, seed=None, **kwargs):
+    """
+    initial book followed by n messages
+    """
+    stream = SyntheticStream(seed=seed, **kwargs)
+    return stream.initial_book() + stream.generate(n)
+
+
+class OrderFlow:
+    """
+    Feed source that generates messages on the fly around the quote of a live OrderBook, including any algo orders
+    and fills. The Feed pulls the next message of a source before the current one is processed, so the book may not
+    have seen the last generated message yet: executes leave room for what that message can still take out of a
+    side. The book is attached after construction, e.g. by the Simulator; the initial book does not need it
+    """
+    def __init__(self, n, order_book=None, depth=10, cancel_ratio=0.4, execute_ratio=0.1, replace_ratio=0.02,
+                 arrival="exponential", mean_gap=19500, mid=1000000, tick=100, start=342E11, initial_orders=3,
+                 max_orders=None, seed=None, block_size=4096, **kwargs):
+        """
+        n messages after the initial book, kwargs go to Arrivals. Once max_orders are live (default 10 per level),
+        adds turn into cancels so that the book stays stationary
+        """
+        self.n = n
+        self.max_orders = 20 * depth if max_orders is None else max_orders
+        self.order_book = order_book
+        self.depth = depth
+        self.thresholds = np.cumsum([cancel_ratio, execute_ratio, replace_ratio])
+        self.mid = mid
+        self.tick = tick
+        self.start = int(start)
+        self.timestamp = self.start
+        self.initial_orders = initial_orders
+        self.block_size = block_size
+        self.rng = np.random.default_rng(seed)
+        self.arrivals = Arrivals(arrival, mean_gap, rng=self.rng, **kwargs)
+        self.next_ref = 1
+        self.last_ref = None  # added by the message the book may not have processed yet
+        self.refs = RefPool()
+        self.sides = {}  # ref -> ask
+        self.pending = {True: 0, False: 0}  # at most the shares the last message removes from each side
+        self.previous = self.pending  # the same for the message before, while the next one is drawn
+        self.added = None  # (ask, price) if the last message added an order
+        self.previous_added = None
+
+    def __len__(self):
+        return 2 * self.depth * self.initial_orders + self.n
+
+    def attach(self, order_book):
+        self.order_book = order_book
+
+    def __iter__(self):
+        self.timestamp = self.start - 2 * self.depth * self.initial_orders
+        for level in range(1, self.depth + 1):
+            for _ in range(self.initial_orders):
+                for ask in [True, False]:
+                    self.timestamp += 1
+                    price = self.mid + level * self.tick if ask else self.mid - level * self.tick
+                    yield self._add(ask, price, 100 * int(self.rng.integers(1, 6)))
+        if self.n > 0 and self.order_book is None:
+            raise RuntimeError("OrderFlow is not attached to an order book")
+        count = 0
+        while count < self.n:
+            size = min(self.block_size, self.n - count)
+            gaps = self.arrivals.draw(size).tolist()
+            events = np.searchsorted(self.thresholds, self.rng.random(size), side="right").tolist()
+            sides = (self.rng.random(size) < 0.5).tolist()
+            levels = (self.rng.geometric(0.3, size) - 1).tolist()  # 0 joins the quote
+            shares = (100 * self.rng.integers(1, 6, size)).tolist()
+            uniforms = self.rng.random(size).tolist()
+            for i in range(size):
+                self.timestamp += gaps[i]
+                yield self._event(events[i], sides[i], min(levels[i], self.depth - 1), shares[i], uniforms[i])
+            count += size
+
+    def _book(self, ask):
+        return self.order_book.ask_book if ask else self.order_book.bid_book
+
+    def _price(self, ask, level, uniform):
+        """
+        level ticks behind the quote, improving the quote by a tick now and then if the spread allows
+        """
+        ask_book, bid_book = self.order_book.ask_book, self.order_book.bid_book
+        ask_quote = ask_book.get_quote() if len(ask_book.levels) > 0 else None
+        bid_quote = bid_book.get_quote() if len(bid_book.levels) > 0 else None
+        if self.previous_added is not None:  # the last add may not be in the book yet, never cross it
+            added_ask, price = self.previous_added
+            if added_ask:
+                ask_quote = price if ask_quote is None else min(ask_quote, price)
+            else:
+                bid_quote = price if bid_quote is None else max(bid_quote, price)
+        if ask_quote is None and bid_quote is None:
+            ask_quote, bid_quote = self.mid + self.tick, self.mid - self.tick
+        elif bid_quote is None:  # one side is gone, quote around the other one
+            bid_quote = ask_quote - self.tick
+        elif ask_quote is None:
+            ask_quote = bid_quote + self.tick
+        if level == 0 and uniform < 0.2 and ask_quote - bid_quote > self.tick:
+            return ask_quote - self.tick if ask else bid_quote + self.tick
+        return ask_quote + level * self.tick if ask else max(bid_quote - level * self.tick, self.tick)
+
+    def _add(self, ask, price, shares):
+        ref = self.next_ref
+        self.next_ref += 1
+        self.refs.add(ref)
+        self.sides[ref] = ask
+        self.last_ref = ref
+        self.added = (ask, price)
+        return _message('AA' if ask else 'AB', ref, self.timestamp, price, shares)
+
+    def _live(self, uniform):
+        """
+        a random order that is still in the book, orders taken out by algo fills are dropped on the way
+        """
+        while len(self.refs) > 0:
+            ref = self.refs.choose(uniform)
+            if ref in self._book(self.sides[ref]) or ref == self.last_ref:
+                return ref
+            self.refs.remove(ref)
+            del self.sides[ref]
+        return None
+
+    def _front_real(self, ask):
+        """
+        the foremost real order that was not deleted or replaced by a generated message
+        """
+        book = self._book(ask)
+        for price in book.levels:
+            for order in book.level_pool[price]:
+                if order.valid and order.real and order.ref in self.sides:
+                    return order
+        return None
+
+    def _available(self, ask, shares):
+        """
+        shares an execute can take from a side (up to shares), whether or not the last message was processed
+        """
+        book = self._book(ask)
+        total = 0
+        for price in book.levels:
+            total += book.volumes[price]
+            if total >= shares + self.previous[ask]:
+                break
+        return total - self.previous[ask]
+
+    def _forget(self, ref):
+        self.refs.remove(ref)
+        del self.sides[ref]
+
+    def _event(self, event, ask, level, shares, uniform):
+        self.previous, self.pending = self.pending, {True: 0, False: 0}
+        self.previous_added, self.added = self.added, None
+        if event == 3 and len(self.refs) >= self.max_orders:
+            event = 0
+        if event == 0:  # cancel or delete
+            ref = self._live(uniform)
+            if ref is not None:
+                side = 'A' if self.sides[ref] else 'B'
+                order = self._book(self.sides[ref]).pool.get(ref)
+                if order is not None and order.shares > 100 and uniform < 0.5:
+                    cancelled = 100 * max(1, int(uniform * order.shares) // 100)
+                    self.pending[self.sides[ref]] = cancelled
+                    return _message('X' + side, ref, self.timestamp, shares=cancelled)
+                self.pending[self.sides[ref]] = 0 if order is None else order.shares
+                self._forget(ref)
+                return _message('D' + side, ref, self.timestamp)
+        if event == 1:  # execute the foremost real order, algo orders ahead of it are filled first
+            order = self._front_real(ask)
+            if order is not None:  # filled orders are dropped lazily, algo orders ahead may take the shares
+                # never the whole side, the last message may still take shares out of it
+                size = min(shares, order.shares, (self._available(ask, shares + 100) - 100) // 100 * 100)
+                if size > 0:
+                    self.pending[ask] = size
+                    return _message('EA' if ask else 'EB', order.ref, self.timestamp, shares=size)
+        if event == 2:  # replace
+            ref = self._live(uniform)
+            if ref is not None:
+                ask = self.sides[ref]
+                order = self._book(ask).pool.get(ref)
+                self.pending[ask] = 0 if order is None else order.shares
+                self._forget(ref)
+                new_ref = self.next_ref
+                msg = self._add(ask, self._price(ask, level, uniform), shares)
+                return _message('UA' if ask else 'UB', ref, self.timestamp, msg.price, shares, new_ref)
+        return self._add(ask, self._price(ask, level, uniform), shares)
+
+
+def to_row(msg):
+    """
+    tagged csv row, as read by FormattedMessage
+    """
+    if msg.type[0] == 'A':
+        return [msg.type, msg.ref, msg.timestamp, 1 if msg.type[1] == 'B' else 0, msg.price, msg.shares]
+    if msg.type[0] == 'U':
+        return [msg.type, msg.ref, msg.timestamp, msg.new_ref, msg.price, msg.shares]
+    if msg.type[0] in 'EXM':
+        return [msg.type, msg.ref, msg.timestamp, '', '', msg.shares]
+    return [msg.type, msg.ref, msg.timestamp, '', '', '']
+
+
+def write_csv(messages, filename):
+    with open(filename, "w", newline="") as f:
+        csv.writer(f, lineterminator="\n").writerows(to_row(msg) for msg in messages)
+
+
+def write_raw_csv(messages, filename):
+    """
+    untagged csv as written by parse2.parse_and_save, algo messages are left out
+    """
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        for msg in messages:
+            if msg.ref < 0 or msg.type[0] == 'M':
+                continue
+            row = to_row(msg)
+            row[0] = msg.type[0]
+            if row[0] == 'E':
+                row[3] = 0  # match number
+            writer.writerow(row)
+
+
+def _itch(msg, locate, stock):
+    timestamp = int(msg.timestamp).to_bytes(6, "big")
+    if msg.type[0] == 'A':
+        return b'A' + struct.pack("!HH6sQcI8sI", locate, 0, timestamp, msg.ref, b'S' if msg.type[1] == 'A' else b'B',
+                                  msg.shares, stock, msg.price)
+    if msg.type[0] == 'E':
+        return b'E' + struct.pack("!HH6sQIQ", locate, 0, timestamp, msg.ref, msg.shares, 0)
+    if msg.type[0] == 'X':
+        return b'X' + struct.pack("!HH6sQI", locate, 0, timestamp, msg.ref, msg.shares)
+    if msg.type[0] == 'D':
+        return b'D' + struct.pack("!HH6sQ", locate, 0, timestamp, msg.ref)
+    if msg.type[0] == 'U':
+        return b'U' + struct.pack("!HH6sQQII", locate, 0, timestamp, msg.ref, msg.new_ref, msg.shares, msg.price)
+    return None
+
+
+def write_itch(messages, filename, stock="AAPL", locate=14, compress=None):
+    """
+    binary ITCH 5.0 with 2 byte length framing: stock directory, the real messages and the end of system event.
+    Compressed with gzip if compress is True or filename ends with .gz
+    """
+    stock = stock.encode().ljust(8)
+    directory = b'R' + struct.pack("!HHHI8sccl", locate, 0, 0, 0, stock, b'Q', b'N', 100) + bytes(14)
+    frames = [directory]
+    for msg in messages:
+        if msg.ref < 0:
+            continue
+        frame = _itch(msg, locate, stock)
+        if frame is not None:
+            frames.append(frame)
+    end = int(messages[-1].timestamp + 1).to_bytes(6, "big")
+    frames.append(b'S' + struct.pack("!HH6sc", 0, 0, end, b'C'))
+    data = b''.join(len(frame).to_bytes(2, "big") + frame for frame in frames)
+    if compress or (compress is None and filename.endswith(".gz")):
+        with gzip.open(filename, "wb") as f:
+            f.write(data)
+    else:
+        with open(filename, "wb") as f:
+            f.write(data)
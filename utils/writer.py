@@ -0,0 +1,137 @@
+"""
+Buffered output to many files, e.g. one csv per symbol. Data is collected in a byte buffer per file and written once
+the buffer is full, or, once all buffers together hold more than max_buffered bytes, the largest ones are written until
+half of that is left. Open handles are kept in an LRU pool, so a flush does not reopen every file. With background=True
+the writes are done by a thread, which overlaps the I/O with parsing
+"""
+import queue
+import threading
+from collections import OrderedDict
+
+
+class FilePool:
+    """
+    at most max_open files open in append mode, the least recently used one is closed first
+    """
+    def __init__(self, max_open=256):
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.opened = 0  # number of open calls, for diagnostics
+
+    def get(self, filename):
+        f = self.files.get(filename)
+        if f is not None:
+            self.files.move_to_end(filename)
+            return f
+        if len(self.files) >= self.max_open:
+            self.files.popitem(last=False)[1].close()
+        f = open(filename, "ab")
+        self.opened += 1
+        self.files[filename] = f
+        return f
+
+    def truncate(self, filename):
+        f = self.files.pop(filename, None)
+        if f is not None:
+            f.close()
+        open(filename, "wb").close()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+class BufferedWriters:
+    def __init__(self, pool=None, buffer_size=1 << 16, background=False, queue_size=64, max_buffered=1 << 28):
+        self.pool = FilePool() if pool is None else pool
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.buffers = {}  # filename -> bytearray
+        self.buffered = 0  # bytes in all buffers, thousands of symbols below buffer_size would add up otherwise
+        self.error = None
+        self.thread = None
+        if background:
+            self.queue = queue.Queue(queue_size)  # bounded, the parser waits if the disk falls behind
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    self.error = e  # raised in the caller's thread by the next write / close
+
+    def _write(self, filename, data):
+        if data is None:
+            self.pool.truncate(filename)
+        else:
+            self.pool.get(filename).write(data)
+
+    def _submit(self, filename, data):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self._write(filename, data)
+        else:
+            self.queue.put((filename, data))
+
+    def truncate(self, filename):
+        """
+        empty the file, in order with the writes around it
+        """
+        buffer = self.buffers.pop(filename, None)
+        if buffer is not None:
+            self.buffered -= len(buffer)
+        self._submit(filename, None)
+
+    def write(self, filename, data: bytes):
+        buffer = self.buffers.get(filename)
+        if buffer is None:
+            buffer = self.buffers[filename] = bytearray()
+        buffer += data
+        self.buffered += len(data)
+        if len(buffer) >= self.buffer_size:
+            self._flush(filename, buffer)
+        elif self.buffered > self.max_buffered:
+            self._shrink()
+
+    def _flush(self, filename, buffer):
+        self._submit(filename, bytes(buffer))
+        self.buffered -= len(buffer)
+        buffer.clear()
+
+    def _shrink(self):
+        # the largest buffers first, down to half the limit so the next writes do not sort again
+        for filename, buffer in sorted(self.buffers.items(), key=lambda item: len(item[1]), reverse=True):
+            if self.buffered <= self.max_buffered // 2 or len(buffer) == 0:
+                break
+            self._flush(filename, buffer)
+
+    def flush(self):
+        for filename, buffer in self.buffers.items():
+            if len(buffer) > 0:
+                self._flush(filename, buffer)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+            self.pool.close()
+        if self.error is not None:
+            raise self.error